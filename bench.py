@@ -0,0 +1,569 @@
+"""Offline benchmark for the music bot.
+
+Drives the real slash command handlers (/play, play_next, the
+MusicControlView buttons, /leave) for N simulated guilds at once, with
+yt-dlp replaced by a stub that answers after a configurable delay and
+voice connections replaced by a client that consumes frames at real time
+through discord.py's own AudioPlayer. Songs are generated locally with
+FFmpeg and served over HTTP, so no Discord or YouTube access is needed.
+
+    python bench.py --guilds 10 --tracks 4 --output before.json
+    python bench.py --guilds 10 --tracks 4 --compare before.json
+
+Results are written as JSON so runs can be compared between commits.
+"""
+
+import argparse
+import asyncio
+import functools
+import http.server
+import itertools
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+parser = argparse.ArgumentParser(description="Benchmark the music bot against local stand-ins")
+parser.add_argument("--guilds", type=int, default=5, help="simulated guilds playing at the same time")
+parser.add_argument("--tracks", type=int, default=4, help="songs queued per guild")
+parser.add_argument("--duration", type=float, default=6, help="length of each song in seconds")
+parser.add_argument("--latency", type=float, default=0.3, help="simulated yt-dlp extraction time in seconds")
+parser.add_argument("--jitter", type=float, default=0.1, help="random extra extraction time, up to this many seconds")
+parser.add_argument("--playlist", type=int, default=0, help="start each guild with a playlist of this many songs instead")
+parser.add_argument("--mode", choices=("opus", "pcm"), default=None, help="AUDIO_MODE for the run")
+parser.add_argument("--seed", type=int, default=1)
+parser.add_argument("--timeout", type=float, default=300, help="give up on a guild after this many seconds")
+parser.add_argument("--label", default="", help="free-form name stored with the results")
+parser.add_argument("--output", help="write the JSON results here instead of stdout")
+parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+args = parser.parse_args()
+
+if not shutil.which("ffmpeg"):
+    sys.exit("FFmpeg is needed to generate and play the benchmark songs")
+
+# Keep the run self-contained: no state database, disk caches, metrics port or pidfile
+os.environ["STATE_DB"] = ""
+os.environ["EXTRACT_CACHE_DIR"] = ""
+os.environ["AUDIO_CACHE_DIR"] = ""
+os.environ["METRICS_PORT"] = "0"
+os.environ["FFMPEG_PIDFILE"] = ""
+if args.mode:
+    os.environ["AUDIO_MODE"] = args.mode
+
+import yt_dlp
+
+OPUS_SILENCE = b'\xf8\xff\xfe'
+FRAME_SECONDS = 0.02
+
+class FakeYoutubeDL:
+    """Stands in for yt_dlp.YoutubeDL, answering from generated metadata"""
+
+    base_url = None  # Set once the media server is running
+    calls = {}
+    lock = threading.Lock()
+    random = random.Random(args.seed)
+
+    def __init__(self, params=None):
+        self.params = params or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    @classmethod
+    def count(cls, kind):
+        with cls.lock:
+            cls.calls[kind] = cls.calls.get(kind, 0) + 1
+            delay = args.latency + cls.random.uniform(0, args.jitter)
+        time.sleep(delay)
+
+    @classmethod
+    def entry(cls, video_id):
+        return {
+            'id': video_id,
+            'title': f"Bench song {video_id}",
+            'duration': args.duration,
+            'url': f"https://www.youtube.com/watch?v={video_id}",
+        }
+
+    @classmethod
+    def video(cls, video_id):
+        return {
+            **cls.entry(video_id),
+            'webpage_url': f"https://www.youtube.com/watch?v={video_id}",
+            'url': f"{cls.base_url}/song.webm?id={video_id}",
+            'acodec': 'opus',
+            'ext': 'webm',
+        }
+
+    def extract_info(self, url, download=False, process=True):
+        if 'list=' in url:
+            self.count('playlist')
+            playlist_id = url.split('list=', 1)[1]
+            size = args.playlist
+
+            def entries():
+                for i in range(size):
+                    if i and i % 25 == 0:
+                        self.count('playlist_page')
+                    yield self.entry(f"{playlist_id}{i:05d}")
+
+            return {'_type': 'playlist', 'title': f"Bench playlist {playlist_id}", 'entries': entries()}
+
+        if url.startswith(('ytsearch', 'ytsearch:')) or not url.startswith('http'):
+            self.count('search')
+            return {'entries': [self.video(f"srch{abs(hash(url)) % 10000000:07d}")]}
+
+        self.count('single')
+        return self.video(url.split('v=', 1)[1][:11])
+
+yt_dlp.YoutubeDL = FakeYoutubeDL
+
+import discord
+from discord.player import AudioPlayer
+
+import bot
+
+# Fake Discord objects
+
+class FakeMessage:
+    ids = itertools.count(1)
+
+    def __init__(self, channel, content, view=None):
+        self.id = next(self.ids)
+        self.channel = channel
+        self.content = content
+        self.view = view
+
+    async def edit(self, content=None, **kwargs):
+        if content is not None:
+            self.content = content
+        if 'view' in kwargs:
+            self.view = kwargs['view']
+
+    async def delete(self):
+        self.channel.messages.remove(self)
+
+class FakeTextChannel:
+    def __init__(self, guild):
+        self.guild = guild
+        self.id = guild.id + 1
+        self.messages = []
+
+    async def send(self, content=None, **kwargs):
+        message = FakeMessage(self, content, kwargs.get('view'))
+        self.messages.append(message)
+        self.guild.report.note_message(content)
+        return message
+
+    def get_partial_message(self, message_id):
+        for message in self.messages:
+            if message.id == message_id:
+                return message
+        raise LookupError(message_id)
+
+    @property
+    def last_view(self):
+        for message in reversed(self.messages):
+            if message.view is not None:
+                return message.view
+        return None
+
+class FakeVoiceChannel:
+    def __init__(self, guild):
+        self.guild = guild
+        self.id = guild.id + 2
+        self.members = []
+
+    async def connect(self, **kwargs):
+        voice_client = FakeVoiceClient(self)
+        bot.bot._connection._add_voice_client(self.guild.id, voice_client)
+        return voice_client
+
+class FakeVoiceWebSocket:
+    async def speak(self, state):
+        pass
+
+class Playback:
+    """Packets seen for one VoiceClient.play() call"""
+
+    def __init__(self, cause, requested_at):
+        self.cause = cause  # play, skip, prev or transition
+        self.requested_at = requested_at
+        self.first_packet = None
+        self.last_packet = None
+        self.frames = 0
+
+class FakeVoiceClient:
+    """Voice connection that plays sources through discord.py's AudioPlayer, minus the UDP socket"""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.guild = channel.guild
+        self.client = bot.bot
+        self.ws = FakeVoiceWebSocket()
+        self.timeout = 5
+        self.encoder = None
+        self._player = None
+        self._connected = True
+
+    def is_connected(self):
+        return self._connected
+
+    def wait_until_connected(self, timeout=None):
+        return self._connected
+
+    def send_audio_packet(self, data, encode=True):
+        if data == OPUS_SILENCE and not encode:
+            return
+        if encode and self.encoder is not None:
+            self.encoder.encode(data, self.encoder.SAMPLES_PER_FRAME)
+        now = time.perf_counter()
+        playback = threading.current_thread().playback
+        if playback.first_packet is None:
+            playback.first_packet = now
+        playback.last_packet = now
+        playback.frames += 1
+
+    def play(self, source, *, after=None, **kwargs):
+        if self.is_playing():
+            raise discord.ClientException('Already playing audio.')
+        if not source.is_opus() and discord.opus.is_loaded():
+            self.encoder = discord.opus.Encoder()
+        self._player = AudioPlayer(source, self, after=after)
+        self._player.playback = self.guild.report.playback_started()
+        self._player.start()
+
+    def is_playing(self):
+        return self._player is not None and self._player.is_playing()
+
+    def is_paused(self):
+        return self._player is not None and self._player.is_paused()
+
+    def stop(self):
+        if self._player:
+            self._player.stop()
+            self._player = None
+
+    def pause(self):
+        if self._player:
+            self._player.pause()
+
+    def resume(self):
+        if self._player:
+            self._player.resume()
+
+    @property
+    def source(self):
+        return self._player.source if self._player else None
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self, *, force=False):
+        self.stop()
+        self._connected = False
+        bot.bot._connection._remove_voice_client(self.guild.id)
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self._done = False
+
+    def is_done(self):
+        return self._done
+
+    async def defer(self, **kwargs):
+        self._done = True
+
+    async def send_message(self, content=None, **kwargs):
+        self._done = True
+        self.interaction.guild.report.note_message(content)
+
+    async def edit_message(self, **kwargs):
+        self._done = True
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, **kwargs):
+        self.interaction.guild.report.note_message(content)
+        return FakeMessage(self.interaction.channel, content, kwargs.get('view'))
+
+class FakeInteraction:
+    def __init__(self, guild, user_id):
+        self.guild = guild
+        self.channel = guild.text_channel
+        self.user = SimpleNamespace(id=user_id, voice=SimpleNamespace(channel=guild.voice_channel))
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+
+class GuildReport:
+    """Everything measured for one simulated guild"""
+
+    def __init__(self):
+        self.playbacks = []
+        self.pending = None  # (cause, perf_counter) of the action that should start the next playback
+        self.errors = []
+
+    def expect(self, cause):
+        self.pending = (cause, time.perf_counter())
+
+    def playback_started(self):
+        cause, requested_at = self.pending or ('transition', None)
+        self.pending = None
+        playback = Playback(cause, requested_at)
+        self.playbacks.append(playback)
+        return playback
+
+    def note_message(self, content):
+        if content and ('error' in content.lower() or 'failed' in content.lower()):
+            self.errors.append(content)
+
+    def gaps(self):
+        """Seconds of silence before each playback's first packet, by cause"""
+        gaps = {}
+        previous = None
+        for playback in self.playbacks:
+            if playback.first_packet is not None:
+                start = playback.requested_at
+                if playback.cause == 'transition':
+                    start = previous.last_packet if previous is not None else None
+                if start is not None:
+                    gaps.setdefault(playback.cause, []).append(playback.first_packet - start)
+            previous = playback
+        return gaps
+
+class FakeGuild:
+    def __init__(self, index):
+        self.index = index
+        self.id = 1000000 + index * 10
+        self.name = f"bench-{index}"
+        self.report = GuildReport()
+        self.text_channel = FakeTextChannel(self)
+        self.voice_channel = FakeVoiceChannel(self)
+
+    @property
+    def voice_client(self):
+        return bot.bot._connection._get_voice_client(self.id)
+
+# Local media
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def start_media_server(directory):
+    """Generate the benchmark song and serve it over HTTP, like a stream URL"""
+    path = os.path.join(directory, "song.webm")
+    subprocess.run([
+        "ffmpeg", "-v", "error", "-y", "-f", "lavfi",
+        "-i", f"sine=frequency=440:sample_rate=48000:duration={args.duration}",
+        "-ac", "2", "-c:a", "libopus", "-b:a", "96k", path,
+    ], check=True)
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), functools.partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    FakeYoutubeDL.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    return server
+
+# Scenario
+
+async def wait_until(predicate, timeout):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise TimeoutError
+        await asyncio.sleep(0.02)
+
+def song_url(guild, number):
+    return f"https://www.youtube.com/watch?v=bench{guild.index:03d}{number:03d}"
+
+async def run_guild(guild):
+    """/play a song, queue more, let one transition happen, press Next and Prev, then play out and /leave"""
+    report = guild.report
+    user_id = guild.id + 5
+    interaction = lambda: FakeInteraction(guild, user_id)
+    expected = args.tracks
+
+    report.expect('play')
+    if args.playlist:
+        await bot.play.callback(interaction(), f"https://www.youtube.com/playlist?list=PL{guild.index:04d}")
+        expected = args.playlist
+    else:
+        for number in range(args.tracks):
+            await bot.play.callback(interaction(), song_url(guild, number))
+
+    try:
+        if expected >= 3:
+            # Natural end of the first song
+            await wait_until(lambda: len(report.playbacks) >= 2, args.timeout)
+            await wait_until(lambda: report.playbacks[-1].first_packet is not None, args.timeout)
+
+            view = guild.text_channel.last_view
+            count = len(report.playbacks)
+            report.expect('skip')
+            await view.next_button.callback(interaction())
+            await wait_until(lambda: len(report.playbacks) > count
+                             and report.playbacks[-1].first_packet is not None, args.timeout)
+
+            view = guild.text_channel.last_view
+            count = len(report.playbacks)
+            report.expect('prev')
+            await view.prev_button.callback(interaction())
+            await wait_until(lambda: len(report.playbacks) > count
+                             and report.playbacks[-1].first_packet is not None, args.timeout)
+
+        player = bot.get_player(guild.id)
+        await wait_until(lambda: guild.voice_client is not None and not guild.voice_client.is_playing()
+                         and not player.queue and player.playlist_import is None
+                         and len(report.playbacks) >= expected, args.timeout)
+    except TimeoutError:
+        report.errors.append("timed out")
+
+    await bot.leave.callback(interaction())
+
+async def sample_resources(samples, stop):
+    """Record bot and FFmpeg memory while the guilds play"""
+    while not stop.is_set():
+        usage = bot.process_usage(os.getpid())
+        ffmpeg = [bot.process_usage(pid) for pid in list(bot.ffmpeg_processes)]
+        ffmpeg = [u[1] for u in ffmpeg if u and u[1]]  # Exited but not yet reaped processes have no RSS
+        samples.append({
+            'rss': usage[1] if usage else 0,
+            'ffmpeg_count': len(ffmpeg),
+            'ffmpeg_rss': sum(ffmpeg),
+        })
+        try:
+            await asyncio.wait_for(stop.wait(), 0.25)
+        except asyncio.TimeoutError:
+            pass
+
+def summarize(values):
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {
+        'n': len(values),
+        'mean': round(sum(values) / len(values), 4),
+        'p50': round(pick(0.5), 4),
+        'p95': round(pick(0.95), 4),
+        'max': round(values[-1], 4),
+    }
+
+def git_revision():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=here, capture_output=True,
+                                  text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                               cwd=here, capture_output=True, text=True).stdout.strip()
+        return revision + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def run():
+    bot.bot.loop = asyncio.get_running_loop()
+    guilds = [FakeGuild(i) for i in range(args.guilds)]
+
+    baseline = bot.process_usage(os.getpid())
+    cpu_start = time.process_time()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    children_start = children.ru_utime + children.ru_stime
+    wall_start = time.perf_counter()
+
+    samples = []
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_resources(samples, stop))
+    supervisor = asyncio.create_task(bot.ffmpeg_supervisor.run())  # Sweeps and pre-warms like in the bot
+    await asyncio.gather(*(run_guild(guild) for guild in guilds))
+    stop.set()
+    await sampler
+    supervisor.cancel()
+
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    ffmpeg_cpu = children.ru_utime + children.ru_stime - children_start
+
+    gaps = {}
+    for guild in guilds:
+        for cause, values in guild.report.gaps().items():
+            gaps.setdefault(cause, []).extend(values)
+    frames = sum(p.frames for guild in guilds for p in guild.report.playbacks)
+    audio_seconds = frames * FRAME_SECONDS
+    peak_rss = max((s['rss'] for s in samples), default=0)
+    ffmpeg_per_stream = [s['ffmpeg_rss'] / s['ffmpeg_count'] for s in samples if s['ffmpeg_count']]
+
+    return {
+        'label': args.label,
+        'revision': git_revision(),
+        'config': {
+            'guilds': args.guilds, 'tracks': args.tracks, 'duration': args.duration,
+            'latency': args.latency, 'jitter': args.jitter, 'playlist': args.playlist,
+            'audio_mode': bot.AUDIO_MODE, 'opus_loaded': discord.opus.is_loaded(),
+        },
+        'results': {
+            'time_to_first_audio': summarize(gaps.get('play', [])),
+            'transition_gap': summarize(gaps.get('transition', [])),
+            'skip_gap': summarize(gaps.get('skip', [])),
+            'prev_gap': summarize(gaps.get('prev', [])),
+            'audio_seconds': round(audio_seconds, 2),
+            'wall_seconds': round(wall, 2),
+            'bot_cpu_percent_per_stream': round(100 * cpu / audio_seconds, 3) if audio_seconds else None,
+            'ffmpeg_cpu_percent_per_stream': round(100 * ffmpeg_cpu / audio_seconds, 3) if audio_seconds else None,
+            'rss_mb_per_guild': round((peak_rss - baseline[1]) / args.guilds / 1048576, 3) if baseline else None,
+            'ffmpeg_rss_mb_per_stream': round(sum(ffmpeg_per_stream) / len(ffmpeg_per_stream) / 1048576, 3)
+                                        if ffmpeg_per_stream else None,
+            'extract_calls': dict(FakeYoutubeDL.calls),
+            'errors': [error for guild in guilds for error in guild.report.errors],
+        },
+    }
+
+def compare(base, current):
+    """Print how each result moved relative to an earlier run"""
+    print(f"{'metric':34} {'base':>10} {'current':>10} {'change':>8}", file=sys.stderr)
+    for name, value in current['results'].items():
+        old = base.get('results', {}).get(name)
+        if isinstance(value, dict) and 'p50' in value:
+            rows = [(f"{name} {stat}", (old or {}).get(stat), value[stat]) for stat in ('p50', 'p95')]
+        elif isinstance(value, (int, float)):
+            rows = [(name, old, value)]
+        else:
+            continue
+        for label, before, after in rows:
+            change = f"{(after - before) / before * 100:+.1f}%" if before else ""
+            print(f"{label:34} {before if before is not None else '-':>10} {after:>10} {change:>8}", file=sys.stderr)
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        server = start_media_server(directory)
+        try:
+            results = asyncio.run(run())
+        finally:
+            server.shutdown()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,40 @@
+import time
+startup_started = time.perf_counter()  # Cold start timing includes the imports below
+
 import discord
+from discord import app_commands
 from discord.ext import commands
 from discord.ui import Button, View
-import yt_dlp
 import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import math
 import os
+import re
 import shutil
+import signal
+import sqlite3
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import weakref
+import zlib
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
 from dotenv import load_dotenv
 
+load_dotenv()
+
 # Check for FFmpeg
 def check_ffmpeg():
     """Check if FFmpeg is available"""
@@ -20,7 +48,10 @@ def check_ffmpeg():
     
     return False
 
-if not check_ffmpeg():
+# Every FFmpeg process runs the executable check_ffmpeg() found
+FFMPEG_EXECUTABLE = "ffmpeg" if shutil.which("ffmpeg") or not os.path.exists("ffmpeg.exe") else os.path.abspath("ffmpeg.exe")
+
+def report_missing_ffmpeg():
     print("=" * 60)
     print("ERROR: FFmpeg not found!")
     print("=" * 60)
@@ -35,15 +66,41 @@ if not check_ffmpeg():
     print()
     print("See FFMPEG_INSTALL.md for detailed instructions.")
     print("=" * 60)
-    input("Press Enter to exit...")
-    exit(1)
+    # Only wait for a key when someone is there to press it (not under systemd or launcher.py)
+    if sys.stdin is not None and sys.stdin.isatty():
+        input("Press Enter to exit...")
+
+# Startup timing
+startup_phases = {}  # phase -> seconds
+
+def startup_phase(phase, since):
+    """Record how long a startup phase took, returns the current time"""
+    now = time.perf_counter()
+    startup_phases[phase] = round(now - since, 3)
+    return now
 
 # Bot setup with intents
 intents = discord.Intents.default()
 intents.message_content = True
 intents.voice_states = True
 
-bot = commands.Bot(command_prefix='/', intents=intents)
+# Sharding, normally set by launcher.py for each worker process
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0"))  # 0 = one unsharded connection
+SHARD_IDS = [int(i) for i in os.getenv("SHARD_IDS", "").split(",") if i.strip()] or None  # None = all shards
+
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(command_prefix='/', intents=intents,
+                                  shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+else:
+    bot = commands.Bot(command_prefix='/', intents=intents)
+
+SYNC_COMMANDS = os.getenv("SYNC_COMMANDS", "auto").lower()  # auto (when changed), always or never
+
+def owns_guild(guild_id):
+    """Whether a guild is served by this process's shards"""
+    if not SHARD_COUNT or SHARD_IDS is None:
+        return True
+    return (guild_id >> 22) % SHARD_COUNT in SHARD_IDS
 
 # Optimized yt-dlp options for Raspberry Pi Zero 2W
 # Lower quality = less CPU usage and bandwidth
@@ -73,64 +130,2696 @@ ytdl_format_options = {
     'concurrent_fragment_downloads': 1,  # Reduce parallel downloads
     'buffersize': 4096,  # Smaller buffer
     'http_chunk_size': 1048576,  # 1MB chunks (smaller for Pi)
+    'socket_timeout': 15,  # A stalled connection fails instead of holding an extraction worker
 }
 
-# Separate config for playlist handling
-ytdl_playlist_options = {
-    **ytdl_format_options,
-    'noplaylist': False,
-    'extract_flat': True,  # Don't download metadata for all videos at once
-    'lazy_playlist': True,  # Process playlist items one at a time
-}
+# Separate config for playlist handling
+ytdl_playlist_options = {
+    **ytdl_format_options,
+    'noplaylist': False,
+    'extract_flat': True,  # Don't download metadata for all videos at once
+    'lazy_playlist': True,  # Process playlist items one at a time
+}
+
+# Playback pipeline
+# 'opus' hands Opus packets from FFmpeg straight to discord.py (copied untouched
+# when the stream already is Opus and volume is 100%), 'pcm' decodes to PCM and
+# scales/encodes every frame in Python
+AUDIO_MODE = os.getenv("AUDIO_MODE", "opus").lower()
+OPUS_BITRATE = int(os.getenv("OPUS_BITRATE", "96"))  # kbps, used when FFmpeg has to re-encode
+DEFAULT_VOLUME = int(os.getenv("DEFAULT_VOLUME", "100")) / 100  # 100 keeps the passthrough path
+
+class QualityTier:
+    """Encoding settings for new streams, picked by the quality governor"""
+    __slots__ = ('name', 'bitrate', 'channels', 'compression', 'max_abr')
+
+    def __init__(self, name, bitrate, channels, compression, max_abr):
+        self.name = name
+        self.bitrate = bitrate  # kbps when FFmpeg or discord.py encodes
+        self.channels = channels
+        self.compression = compression  # libopus effort, 0 (cheapest) - 10
+        self.max_abr = max_abr  # Highest source bitrate to stream, in kbps
+
+# Best first; the governor moves one step at a time
+QUALITY_TIERS = (
+    QualityTier('high', 128, 2, 10, 1000),
+    QualityTier('normal', OPUS_BITRATE, 2, 10, 160),
+    QualityTier('low', 64, 2, 5, 80),
+    QualityTier('minimal', 32, 1, 2, 56),
+)
+QUALITY_TIER_INDEX = {tier.name: i for i, tier in enumerate(QUALITY_TIERS)}
+
+# Optimized FFmpeg options for Raspberry Pi Zero 2W
+ffmpeg_options = {
+    'options': '-vn',  # discord.py adds the PCM format itself; the encode bitrate comes from the quality tier
+    'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
+}
+
+# YoutubeDL instances aren't safe to share between threads, each extraction
+# worker creates its own on first use and keeps it. yt-dlp itself is imported
+# on first use too, it takes seconds to load on a Pi.
+_ytdl_local = threading.local()
+
+def get_ytdl(flat=False):
+    """YoutubeDL instance of the calling thread (flat: list search results without resolving them)"""
+    name = 'ytdl_flat' if flat else 'ytdl'
+    ytdl = getattr(_ytdl_local, name, None)
+    if ytdl is None:
+        import yt_dlp
+        options = {**ytdl_format_options, 'extract_flat': True} if flat else ytdl_format_options
+        ytdl = yt_dlp.YoutubeDL(options)
+        setattr(_ytdl_local, name, ytdl)
+    return ytdl
+
+def warm_up_ytdl():
+    """Load yt-dlp and its YouTube extractor ahead of the first /play (blocking)"""
+    get_ytdl().get_info_extractor('Youtube')
+
+# Metrics settings
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 = no HTTP endpoint
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 30)
+
+# Structured events (one JSON object per line) go to this logger
+event_log = logging.getLogger("musicbot.events")
+
+def log_event(event, **fields):
+    event_log.info(json.dumps({'ts': round(time.time(), 3), 'event': event, **fields}))
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metrics:
+    """Small Prometheus-style registry, safe to update from any thread.
+
+    Counters and histograms are stored here; gauges are read at scrape time
+    by collector functions returning (name, labels, value) samples.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._types = {}
+        self._help = {}
+        self._counters = {}    # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self._collectors = []  # (name, fn)
+
+    def describe(self, name, kind, help_text):
+        self._types[name] = kind
+        self._help[name] = help_text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            state = self._histograms.get(key)
+            if state is None:
+                state = self._histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def collector(self, name):
+        """Register fn() -> [(labels dict, value)] as the source of a gauge"""
+        def register(fn):
+            self._collectors.append((name, fn))
+            return fn
+        return register
+
+    def render(self):
+        samples = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                samples.setdefault(name, []).append((dict(labels), value))
+            for (name, labels), state in self._histograms.items():
+                lines = samples.setdefault(name, [])
+                for bound, count in zip(LATENCY_BUCKETS, state):
+                    lines.append((dict(labels, le=str(bound)), count, '_bucket'))
+                lines.append((dict(labels, le='+Inf'), state[-1], '_bucket'))
+                lines.append((dict(labels), state[-2], '_sum'))
+                lines.append((dict(labels), state[-1], '_count'))
+        for name, fn in self._collectors:
+            try:
+                samples.setdefault(name, []).extend(fn())
+            except Exception as e:
+                print(f"Metrics collector {name} failed: {e}")
+
+        out = []
+        for name, lines in samples.items():
+            if name in self._help:
+                out.append(f"# HELP {name} {self._help[name]}")
+                out.append(f"# TYPE {name} {self._types[name]}")
+            for sample in lines:
+                labels, value = sample[0], sample[1]
+                suffix = sample[2] if len(sample) > 2 else ''
+                label_text = ','.join(f'{k}="{escape_label(v)}"' for k, v in labels.items())
+                out.append(f"{name}{suffix}{{{label_text}}} {value}" if label_text else f"{name}{suffix} {value}")
+        return '\n'.join(out) + '\n'
+
+metrics = Metrics()
+metrics.describe('musicbot_extract_seconds', 'histogram', 'yt-dlp extract_info latency by request kind')
+metrics.describe('musicbot_extract_errors_total', 'counter', 'Failed yt-dlp extractions by request kind')
+metrics.describe('musicbot_first_audio_seconds', 'histogram', 'Time from /play or /play-now to the first audio packet')
+metrics.describe('musicbot_transition_gap_seconds', 'histogram', 'Time from the end of a track to the first packet of the next')
+metrics.describe('musicbot_startup_seconds', 'gauge', 'Duration of each startup phase')
+metrics.describe('musicbot_quality_tier', 'gauge', 'Quality tier for new streams (0 = best)')
+metrics.describe('musicbot_system_cpu_ratio', 'gauge', 'System CPU busy share over the last governor sample')
+metrics.describe('musicbot_late_frame_ratio', 'gauge', 'Share of frames requested late over the last governor sample')
+metrics.describe('musicbot_queue_depth', 'gauge', 'Queued songs per guild')
+metrics.describe('musicbot_ffmpeg_processes', 'gauge', 'Running FFmpeg processes')
+metrics.describe('musicbot_ffmpeg_cpu_seconds_total', 'counter', 'CPU time used by each running FFmpeg process')
+metrics.describe('musicbot_ffmpeg_rss_bytes', 'gauge', 'Resident memory of each running FFmpeg process')
+metrics.describe('musicbot_extract_workers', 'gauge', 'Extraction pool size')
+metrics.describe('musicbot_extract_running', 'gauge', 'Extractions running on the pool')
+metrics.describe('musicbot_extract_pending', 'gauge', 'Extractions waiting for a worker')
+metrics.describe('musicbot_extract_coalesced_total', 'counter', 'Extraction requests that joined one already in flight')
+metrics.describe('musicbot_extract_timeouts_total', 'counter', 'Extraction requests that gave up waiting')
+metrics.describe('musicbot_extract_abandoned', 'gauge', 'Extractions still running that nobody waits for anymore')
+metrics.describe('musicbot_extract_cache_total', 'counter', 'Extraction cache lookups by result')
+metrics.describe('musicbot_stream_resumes_total', 'counter', 'Tracks resumed at their position after the stream broke off')
+metrics.describe('musicbot_broadcast_listeners', 'gauge', 'Guilds listening to each broadcast station')
+
+@metrics.collector('musicbot_startup_seconds')
+def collect_startup():
+    return [({'phase': phase}, seconds) for phase, seconds in startup_phases.items()]
+
+def timed_extract(kind, fn):
+    """Call a blocking yt-dlp function and record its latency"""
+    start = time.perf_counter()
+    ok = False
+    try:
+        result = fn()
+        ok = True
+        return result
+    finally:
+        seconds = time.perf_counter() - start
+        metrics.observe('musicbot_extract_seconds', seconds, kind=kind)
+        if not ok:
+            metrics.inc('musicbot_extract_errors_total', kind=kind)
+        log_event('extract', kind=kind, seconds=round(seconds, 3), ok=ok)
+
+# FFmpeg processes spawned for playback, pid -> (guild_id, Popen)
+ffmpeg_processes = {}
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def process_usage(pid):
+    """(cpu seconds, rss bytes) of a process from /proc, or None where that isn't available"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f"/proc/{pid}/statm") as f:
+            rss_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    # utime and stime are fields 14 and 15, counted from the state field (3)
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS, rss_pages * PAGE_SIZE
+
+@metrics.collector('musicbot_ffmpeg_processes')
+def collect_ffmpeg_count():
+    # Exited processes stay listed until the supervisor's next sweep
+    return [({}, sum(1 for guild_id, process in list(ffmpeg_processes.values()) if process.poll() is None))]
+
+@metrics.collector('musicbot_ffmpeg_cpu_seconds_total')
+def collect_ffmpeg_cpu():
+    samples = []
+    for pid, (guild_id, process) in list(ffmpeg_processes.items()):
+        usage = process_usage(pid)
+        if usage:
+            samples.append(({'pid': pid, 'guild': guild_id}, usage[0]))
+    return samples
+
+@metrics.collector('musicbot_ffmpeg_rss_bytes')
+def collect_ffmpeg_rss():
+    samples = []
+    for pid, (guild_id, process) in list(ffmpeg_processes.items()):
+        usage = process_usage(pid)
+        if usage:
+            samples.append(({'pid': pid, 'guild': guild_id}, usage[1]))
+    return samples
+
+# Extraction cache settings
+EXTRACT_CACHE_SIZE = int(os.getenv("EXTRACT_CACHE_SIZE", "256"))  # Entries kept in memory
+EXTRACT_CACHE_TTL = int(os.getenv("EXTRACT_CACHE_TTL", "18000"))  # Upper bound when a URL has no expire= (5h)
+EXTRACT_CACHE_DIR = os.getenv("EXTRACT_CACHE_DIR", "")  # Empty = memory only
+EXTRACT_CACHE_MAX_FILES = int(os.getenv("EXTRACT_CACHE_MAX_FILES", "5000"))  # Files kept on disk, the oldest go first
+EXTRACT_CACHE_PRUNE_EVERY = 200  # Disk writes between prunes of the cache directory
+EXPIRE_MARGIN = 600  # Refresh stream URLs this many seconds before googlevideo expires them
+
+# Only these fields are needed for playback, the full info dict is ~100KB per track
+CACHED_INFO_KEYS = ('id', 'title', 'url', 'duration', 'webpage_url', 'thumbnail', 'uploader',
+                    'acodec', 'ext', 'abr', 'asr', 'http_headers', 'audio_formats')
+
+YOUTUBE_ID_RE = re.compile(r'(?:[?&]v=|youtu\.be/|/shorts/|/embed/|/live/)([A-Za-z0-9_-]{11})')
+EXPIRE_RE = re.compile(r'[?&/]expire[=/](\d+)')
+
+def video_id(url):
+    """Return the YouTube video ID in a URL, or None"""
+    match = YOUTUBE_ID_RE.search(url)
+    return match.group(1) if match else None
+
+def cache_key(url):
+    """Normalize a URL or search query to a cache key.
+
+    YouTube links become their video ID. Other URLs are kept as they are,
+    since paths and IDs are case-sensitive; only search text is folded.
+    """
+    key = video_id(url)
+    if key:
+        return key
+    url = url.strip()
+    if url.startswith(('http://', 'https://')):
+        return url
+    return 'search:' + ' '.join(url.lower().split())
+
+def stream_expiry(data):
+    """Return the unix time the stream URL stops working, or None if unknown"""
+    match = EXPIRE_RE.search(data.get('url') or '')
+    return int(match.group(1)) if match else None
+
+class ExtractionCache:
+    """LRU cache of extracted track info with an optional on-disk store.
+
+    Entries expire at the stream URL's expire= timestamp (minus a margin) so
+    an expired googlevideo URL is re-extracted instead of being handed to FFmpeg.
+    Expired files are deleted when read and by a prune at startup and every
+    EXTRACT_CACHE_PRUNE_EVERY writes, which also keeps at most max_files.
+    """
+
+    def __init__(self, max_entries, ttl, directory=None, max_files=EXTRACT_CACHE_MAX_FILES):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.max_files = max_files
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self._entries = OrderedDict()  # key -> (expires_at, data)
+        self._lock = threading.Lock()
+        self._writes = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.prune()
+
+    def expires_at(self, data):
+        now = time.time()
+        expiry = stream_expiry(data)
+        if expiry is None:
+            return now + self.ttl
+        return min(expiry - EXPIRE_MARGIN, now + self.ttl)
+
+    def get(self, key):
+        """Return (data, stale) from memory; data is None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None, False
+            if entry[0] <= time.time():
+                del self._entries[key]
+                return None, True
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], False
+
+    def fetch(self, key, extract, stale=False):
+        """Load from disk or call extract(). Blocking, run it in an executor."""
+        entry = self._load(key)
+        if entry is not None:
+            if entry[0] > time.time():
+                with self._lock:
+                    self.hits += 1
+                self._remember(key, entry)
+                return entry[1]
+            stale = True
+
+        with self._lock:
+            if stale:
+                self.refreshes += 1
+            else:
+                self.misses += 1
+
+        return self.put(key, extract())
+
+    def discard(self, key, url):
+        """Forget an entry whose stream URL stopped working, unless it was refreshed since"""
+        def uses_url(data):
+            return data.get('url') == url or any(f.get('url') == url for f in data.get('audio_formats') or ())
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and uses_url(entry[1]):
+                del self._entries[key]
+        entry = self._load(key)
+        if entry is not None and uses_url(entry[1]):
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def put(self, key, data):
+        data = {k: data[k] for k in CACHED_INFO_KEYS if k in data}
+        entry = (self.expires_at(data), data)
+        keys = {key}
+        if data.get('id'):
+            # Searches also become reachable by the ID of the video they found
+            keys.add(data['id'])
+        for k in keys:
+            self._remember(k, entry)
+            self._store(k, entry)
+        return data
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses + self.refreshes
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'refreshes': self.refreshes,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+    def prune(self):
+        """Delete expired and surplus files from the cache directory (blocking)"""
+        now = time.time()
+        files = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError as e:
+            print(f"Extraction cache prune error: {e}")
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue  # Removed by another worker meanwhile
+            if name.endswith('.tmp'):
+                # Left behind by a crash mid-write; give a live writer a minute
+                expired = mtime < now - 60
+            elif name.endswith('.json'):
+                # No entry outlives the TTL from when it was written
+                expired = mtime < now - self.ttl
+            else:
+                continue
+            if expired:
+                self._remove(path)
+            elif name.endswith('.json'):
+                files.append((mtime, path))
+        if len(files) > self.max_files:
+            files.sort()
+            for _, path in files[:len(files) - self.max_files]:
+                self._remove(path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _load(self, key):
+        """(expires_at, data) from disk; an expired entry is returned once and its file deleted"""
+        if not self.directory:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                record = json.load(f)
+            entry = record['expires_at'], record['data']
+        except OSError:
+            return None
+        except (ValueError, KeyError):
+            self._remove(path)  # Unreadable, extracting again rewrites it
+            return None
+        if entry[0] <= time.time():
+            self._remove(path)
+        return entry
+
+    def _store(self, key, entry):
+        if not self.directory:
+            return
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'expires_at': entry[0], 'data': entry[1]}, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Extraction cache write error: {e}")
+        with self._lock:
+            self._writes += 1
+            due = self._writes % EXTRACT_CACHE_PRUNE_EVERY == 0
+        if due:
+            self.prune()
+
+extraction_cache = ExtractionCache(EXTRACT_CACHE_SIZE, EXTRACT_CACHE_TTL, EXTRACT_CACHE_DIR or None)
+
+# Extraction scheduler settings
+# Leave a core free for FFmpeg and the voice thread (3 workers on a 4-core Pi)
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", str(max(1, min(3, (os.cpu_count() or 2) - 1)))))
+EXTRACT_TIMEOUT = float(os.getenv("EXTRACT_TIMEOUT", "30"))  # Seconds before a request gives up
+EXTRACT_SPARE_WORKERS = int(os.getenv("EXTRACT_SPARE_WORKERS", "2"))  # Extra threads while abandoned extractions still run
+
+PRIORITY_INTERACTIVE = 0  # Someone is waiting on the reply (/play, /play-now)
+PRIORITY_BACKGROUND = 1   # Prefetch and other work nobody is blocked on
+
+class ExtractionCancelled(Exception):
+    pass
+
+class ExtractionWaiter:
+    __slots__ = ('future', 'guild_id', 'requester_id')
+
+    def __init__(self, future, guild_id, requester_id):
+        self.future = future
+        self.guild_id = guild_id
+        self.requester_id = requester_id
+
+class ExtractionJob:
+    __slots__ = ('fn', 'key', 'guild_id', 'priority', 'waiters', 'started')
+
+    def __init__(self, fn, key, guild_id, priority):
+        self.fn = fn
+        self.key = key
+        self.guild_id = guild_id
+        self.priority = priority
+        self.waiters = []
+        self.started = False
+
+    def wanted(self):
+        return any(not waiter.future.done() for waiter in self.waiters)
+
+class ExtractionScheduler:
+    """Runs blocking yt-dlp calls on a bounded thread pool.
+
+    Waiting jobs sit in per-guild queues that are served round-robin, with
+    interactive requests ahead of background work, so one guild importing a
+    playlist cannot starve everyone else's /play.
+
+    Jobs submitted with a key are single-flight: while one is queued or
+    running, later requests for the same key wait on it instead of running
+    yt-dlp again. Every caller keeps its own future, so a timeout or
+    cancellation only affects that caller.
+
+    A running yt-dlp call can't be interrupted. Once everyone waiting on it
+    has given up, it stops counting against the pool and up to spare extra
+    threads take new jobs, so hung extractions can't take every worker.
+    """
+
+    def __init__(self, workers, timeout, spare=0):
+        self.workers = workers
+        self.timeout = timeout
+        self.spare = spare
+        self.coalesced = 0
+        self.timeouts = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers + spare, thread_name_prefix='ytdl')
+        # One round-robin ring of guild queues per priority level
+        self._pending = (OrderedDict(), OrderedDict())
+        self._active = set()
+        self._jobs = {}  # key -> queued or running job
+
+    async def run(self, fn, *, key=None, guild_id=None, priority=PRIORITY_INTERACTIVE, requester_id=None, timeout=None):
+        """Run fn() on a worker thread and return its result"""
+        loop = asyncio.get_running_loop()
+        waiter = ExtractionWaiter(loop.create_future(), guild_id, requester_id)
+        job = self._jobs.get(key) if key is not None else None
+        if job is None:
+            job = ExtractionJob(fn, key, guild_id, priority)
+            if key is not None:
+                self._jobs[key] = job
+            self._pending[priority].setdefault(guild_id, deque()).append(job)
+        else:
+            self.coalesced += 1
+            if not job.started and priority < job.priority:
+                # Someone is now waiting on a background job, let it jump ahead;
+                # the copy left in the background ring is skipped once started
+                job.priority = priority
+                self._pending[priority].setdefault(job.guild_id, deque()).append(job)
+        job.waiters.append(waiter)
+        self._pump()
+
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            return await asyncio.wait_for(waiter.future, timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise TimeoutError(f"Extraction timed out after {timeout:g}s") from None
+        finally:
+            job.waiters.remove(waiter)
+            if not job.started and not job.wanted() and self._jobs.get(key) is job:
+                # Nobody is left waiting, don't start it
+                del self._jobs[key]
+            elif job.started and not job.wanted():
+                # Abandoned while running, its worker slot is free for the pool again
+                self._pump()
+
+    def cancel_guild(self, guild_id, requester_id=None):
+        """Fail the queued and running requests of a guild (optionally only one requester's)"""
+        jobs = set(self._active)
+        for ring in self._pending:
+            for queued in ring.values():
+                jobs.update(queued)
+
+        cancelled = 0
+        for job in jobs:
+            for waiter in job.waiters:
+                if waiter.guild_id != guild_id or waiter.future.done():
+                    continue
+                if requester_id is not None and waiter.requester_id != requester_id:
+                    continue
+                # A running yt-dlp call can't be interrupted, the caller just stops waiting;
+                # other guilds sharing the job still get its result
+                waiter.future.set_exception(ExtractionCancelled("Request was cancelled"))
+                cancelled += 1
+        return cancelled
+
+    def stats(self):
+        pending = {job for ring in self._pending for jobs in ring.values() for job in jobs
+                   if not job.started and job.wanted()}
+        return {
+            'workers': self.workers,
+            'running': len(self._active),
+            'abandoned': sum(1 for job in self._active if not job.wanted()),
+            'pending': len(pending),
+            'coalesced': self.coalesced,
+            'timeouts': self.timeouts,
+        }
+
+    def _next_job(self):
+        for ring in self._pending:
+            while ring:
+                guild_id, jobs = next(iter(ring.items()))
+                job = jobs.popleft()
+                if jobs:
+                    ring.move_to_end(guild_id)
+                else:
+                    del ring[guild_id]
+                if not job.started and job.wanted():
+                    return job
+        return None
+
+    def _pump(self):
+        while True:
+            busy = sum(1 for job in self._active if job.wanted())
+            if busy >= self.workers or len(self._active) >= self.workers + self.spare:
+                return
+            job = self._next_job()
+            if job is None:
+                return
+            job.started = True
+            self._active.add(job)
+            future = asyncio.get_running_loop().run_in_executor(self._executor, job.fn)
+            future.add_done_callback(partial(self._finished, job))
+
+    def _finished(self, job, future):
+        self._active.discard(job)
+        if job.key is not None and self._jobs.get(job.key) is job:
+            del self._jobs[job.key]
+
+        delivered = False
+        for waiter in job.waiters:
+            if waiter.future.done():
+                continue
+            delivered = True
+            if future.cancelled():
+                waiter.future.set_exception(ExtractionCancelled("Request was cancelled"))
+            elif future.exception() is not None:
+                waiter.future.set_exception(future.exception())
+            else:
+                waiter.future.set_result(future.result())
+        if not delivered and not future.cancelled():
+            # Nobody is waiting anymore, mark the exception as retrieved
+            future.exception()
+        self._pump()
+
+extractor = ExtractionScheduler(EXTRACT_WORKERS, EXTRACT_TIMEOUT, EXTRACT_SPARE_WORKERS)
+
+@metrics.collector('musicbot_extract_workers')
+def collect_extract_workers():
+    return [({}, extractor.workers)]
+
+@metrics.collector('musicbot_extract_running')
+def collect_extract_running():
+    return [({}, extractor.stats()['running'])]
+
+@metrics.collector('musicbot_extract_pending')
+def collect_extract_pending():
+    return [({}, extractor.stats()['pending'])]
+
+@metrics.collector('musicbot_extract_coalesced_total')
+def collect_extract_coalesced():
+    return [({}, extractor.coalesced)]
+
+@metrics.collector('musicbot_extract_timeouts_total')
+def collect_extract_timeouts():
+    return [({}, extractor.timeouts)]
+
+@metrics.collector('musicbot_extract_abandoned')
+def collect_extract_abandoned():
+    return [({}, extractor.stats()['abandoned'])]
+
+@metrics.collector('musicbot_extract_cache_total')
+def collect_extract_cache():
+    stats = extraction_cache.stats()
+    return [({'result': result}, stats[result]) for result in ('hits', 'misses', 'refreshes')]
+
+def extract_track(url):
+    """Run yt-dlp for a single track, unwrapping search results (blocking)"""
+    kind = 'single' if url.startswith(('http://', 'https://')) else 'search'
+    data = timed_extract(kind, lambda: get_ytdl().extract_info(url, download=False))
+    if 'entries' in data:
+        # Take first item from a playlist
+        data = data['entries'][0]
+    # Keep the audio-only formats so the quality governor can pick one at play time
+    data['audio_formats'] = [
+        {key: f.get(key) for key in ('format_id', 'url', 'acodec', 'abr', 'ext')}
+        for f in data.get('formats') or ()
+        if f.get('url') and f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')
+    ]
+    return data
+
+def select_stream(data, tier):
+    """Stream info for the best audio format the tier allows, preferring Opus"""
+    formats = data.get('audio_formats')
+    if not formats:
+        return data
+    fitting = [f for f in formats if (f.get('abr') or 0) <= tier.max_abr]
+    if fitting:
+        chosen = max(fitting, key=lambda f: (f.get('acodec') == 'opus', f.get('abr') or 0))
+    else:
+        chosen = min(formats, key=lambda f: f.get('abr') or 0)
+    if chosen['url'] == data.get('url'):
+        return data
+    return {**data, **chosen}
+
+# Search autocomplete settings
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "256"))  # Queries remembered
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "3600"))  # Seconds search results stay fresh
+SEARCH_RESULTS = 5  # Videos fetched per search
+TITLE_INDEX_SIZE = int(os.getenv("TITLE_INDEX_SIZE", "2000"))  # Played songs suggested without searching
+AUTOCOMPLETE_DEBOUNCE = 0.3  # Wait for the user to stop typing before searching
+AUTOCOMPLETE_TIMEOUT = 2.0  # Discord drops autocomplete answers after 3 seconds
+
+def normalize_query(text):
+    return ' '.join(text.lower().split())
+
+def watch_url(video_id):
+    return f"https://www.youtube.com/watch?v={video_id}"
+
+class SearchCache:
+    """TTL/LRU cache of search query -> [(video_id, title, duration)]
+
+    Filled from extraction worker threads and read on the event loop.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # query -> (expires_at, results)
+        self._lock = threading.Lock()
+
+    def get(self, query):
+        with self._lock:
+            entry = self._entries.get(query)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._entries[query]
+                return None
+            self._entries.move_to_end(query)
+            return entry[1]
+
+    def put(self, query, results):
+        with self._lock:
+            self._entries[query] = (time.time() + self.ttl, results)
+            self._entries.move_to_end(query)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+search_cache = SearchCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+
+class TitleIndex:
+    """Prefix index over the titles of songs played on any server.
+
+    Every word start of a title is a key in one sorted list, so typing the
+    beginning of any word sequence in a title finds it with a bisect.
+    """
+
+    def __init__(self, max_tracks):
+        self.max_tracks = max_tracks
+        self._keys = []  # sorted (key, video_id)
+        self._tracks = OrderedDict()  # video_id -> (title, duration, keys)
+
+    def add(self, video_id, title, duration=None):
+        if not video_id or not title:
+            return
+        if video_id in self._tracks:
+            self._tracks.move_to_end(video_id)
+            return
+        words = normalize_query(title).split(' ')
+        keys = {' '.join(words[i:]) for i in range(len(words))}
+        for key in keys:
+            bisect.insort(self._keys, (key, video_id))
+        self._tracks[video_id] = (title, duration, keys)
+        while len(self._tracks) > self.max_tracks:
+            old_id, (_, _, old_keys) = self._tracks.popitem(last=False)
+            for key in old_keys:
+                i = bisect.bisect_left(self._keys, (key, old_id))
+                if i < len(self._keys) and self._keys[i] == (key, old_id):
+                    del self._keys[i]
+
+    def search(self, prefix, limit):
+        """[(video_id, title, duration)] of played songs with a word sequence starting with prefix"""
+        results = []
+        seen = set()
+        i = bisect.bisect_left(self._keys, (prefix,))
+        while i < len(self._keys) and len(results) < limit:
+            key, video_id = self._keys[i]
+            if not key.startswith(prefix):
+                break
+            if video_id not in seen:
+                seen.add(video_id)
+                title, duration, _ = self._tracks[video_id]
+                results.append((video_id, title, duration))
+            i += 1
+        return results
+
+title_index = TitleIndex(TITLE_INDEX_SIZE)
+
+def search_videos(query):
+    """Flat YouTube search, returns [(video_id, title, duration)] (blocking)"""
+    data = timed_extract('autocomplete', lambda: get_ytdl(flat=True).extract_info(
+        f"ytsearch{SEARCH_RESULTS}:{query}", download=False))
+    results = []
+    for entry in data.get('entries') or ():
+        if entry and entry.get('id'):
+            duration = entry.get('duration')
+            results.append((entry['id'], entry.get('title') or entry['id'], int(duration) if duration else None))
+    search_cache.put(query, results)
+    return results
+
+def cached_search_url(query):
+    """Watch URL of the top cached search result for free text, so /play skips searching again"""
+    if query.startswith(('http://', 'https://')):
+        return None
+    results = search_cache.get(normalize_query(query))
+    return watch_url(results[0][0]) if results else None
+
+autocomplete_latest = {}  # user_id -> token of their newest keystroke
+autocomplete_searches = {}  # query -> task searching it, outlives the autocomplete request
+
+def start_search(query, guild_id):
+    """Task running a flat search under the normal extraction timeout"""
+    task = autocomplete_searches.get(query)
+    if task is None:
+        task = autocomplete_searches[query] = asyncio.get_running_loop().create_task(
+            extractor.run(lambda: search_videos(query), key='search-flat:' + query, guild_id=guild_id))
+
+        def finished(task):
+            autocomplete_searches.pop(query, None)
+            if not task.cancelled():
+                task.exception()  # Nobody may be waiting anymore, a failed search just stays uncached
+
+        task.add_done_callback(finished)
+    return task
+
+async def url_autocomplete(interaction: discord.Interaction, current: str):
+    """Suggest songs for /play and /play-now while the user types"""
+    started = time.monotonic()
+    query = normalize_query(current)
+    if len(query) < 2 or query.startswith(('http://', 'https://')):
+        return []
+
+    results = title_index.search(query, 25)
+    searched = search_cache.get(query)
+    if searched is None and len(results) < SEARCH_RESULTS:
+        # Only search once the user has paused; a newer keystroke takes over
+        token = object()
+        autocomplete_latest[interaction.user.id] = token
+        await asyncio.sleep(AUTOCOMPLETE_DEBOUNCE)
+        if autocomplete_latest.get(interaction.user.id) is token:
+            task = start_search(query, interaction.guild_id)
+            try:
+                # Shielded, so a search still queued or running when the window closes
+                # keeps its place and lands in the cache for the next keystroke
+                searched = await asyncio.wait_for(asyncio.shield(task),
+                                                  max(0.1, AUTOCOMPLETE_TIMEOUT - (time.monotonic() - started)))
+            except Exception as e:
+                print(f"Autocomplete search for {query!r} not ready: {e!r}")
+            finally:
+                if autocomplete_latest.get(interaction.user.id) is token:
+                    del autocomplete_latest[interaction.user.id]
+
+    seen = {video_id for video_id, _, _ in results}
+    results.extend(result for result in searched or () if result[0] not in seen)
+    choices = []
+    for video_id, title, duration in results[:25]:
+        suffix = f" ({format_duration(duration)})" if duration else ""
+        name = title[:100 - len(suffix)] + suffix
+        choices.append(app_commands.Choice(name=name, value=watch_url(video_id)))
+    return choices
+
+# Local audio cache settings
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", "")  # Empty = disabled
+AUDIO_CACHE_MAX_MB = int(os.getenv("AUDIO_CACHE_MAX_MB", "512"))
+AUDIO_CACHE_POLICY = os.getenv("AUDIO_CACHE_POLICY", "lru").lower()  # lru or lfu
+AUDIO_CACHE_INDEX_INTERVAL = 60  # Seconds between saves of changed use counts and times
+
+AUDIO_CACHE_MAGIC = b'OPKT1\n'
+FRAME_SECONDS = 0.02  # discord.py sends one Opus packet every 20 ms
+OPUS_HEADERS = (b'OpusHead', b'OpusTags')  # Ogg stream headers FFmpegOpusAudio yields before the audio
+
+def is_opus_header(packet):
+    """True for the OpusHead/OpusTags packets, which aren't audio and can't be decoded"""
+    return packet[:8] in OPUS_HEADERS
+
+class AudioCacheWriter:
+    """Records the Opus packets of one track into a .part file"""
+
+    def __init__(self, cache, video_id, path, title, duration):
+        self.cache = cache
+        self.video_id = video_id
+        self.path = path
+        self.title = title
+        self.duration = duration
+        self.packets = 0
+        self.complete = False  # Set when the source hit EOF rather than being stopped
+        self._file = open(path, 'wb')
+        self._file.write(AUDIO_CACHE_MAGIC)
+
+    def write(self, packet):
+        if self._file is None or is_opus_header(packet):
+            return
+        try:
+            self._file.write(len(packet).to_bytes(2, 'big'))
+            self._file.write(packet)
+            self.packets += 1
+        except OSError as e:
+            print(f"Audio cache write error: {e}")
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        """Publish or drop the recording on the cache's own thread, not the audio player's"""
+        self.cache.submit(self._close)
+
+    def _close(self):
+        """Publish the recording if the whole track was captured, otherwise drop it (blocking)"""
+        keep = self._file is not None and self.complete
+        if keep and self.duration:
+            # An expired stream URL also ends in EOF, don't keep a truncated track
+            keep = self.packets * FRAME_SECONDS >= self.duration - 2
+        if self._file is not None:
+            try:
+                if keep:
+                    self._file.flush()
+                    os.fsync(self._file.fileno())
+                self._file.close()
+            except OSError as e:
+                print(f"Audio cache write error: {e}")
+                keep = False
+        self.cache.finish(self, keep)
+
+class AudioCache:
+    """Byte-budgeted store of the Opus packets of tracks that played to the end.
+
+    Files hold the length-prefixed audio packets as they went to Discord, so a
+    replay needs neither the network nor FFmpeg. Recordings are written to a
+    .part file and only renamed into place once complete, so a partial file
+    is never served. Finishing a recording and saving the index happen on a
+    dedicated thread; use counts and times are saved every
+    AUDIO_CACHE_INDEX_INTERVAL and at shutdown.
+    """
+
+    def __init__(self, directory, max_bytes, policy='lru'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self._index = {}  # video_id -> [size, last_used, hits, title, duration]
+        self._writing = set()
+        self._lock = threading.Lock()
+        self._used = False  # Use counts changed since the index was saved
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='audio-cache')
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._scan()
+
+    def lookup(self, video_id):
+        """Return (path, title, duration) for a cached video and count the use, or None"""
+        with self._lock:
+            entry = self._index.get(video_id)
+            if entry is None:
+                return None
+            entry[1] = time.time()
+            entry[2] += 1
+            self._used = True
+            return self._path(video_id), entry[3], entry[4]
+
+    def contains(self, video_id):
+        return video_id in self._index
+
+    def record(self, data):
+        """Start recording a track, returns None if it is cached or already being recorded"""
+        video_id = data.get('id')
+        if not self.directory or not video_id:
+            return None
+        with self._lock:
+            if video_id in self._index or video_id in self._writing:
+                return None
+            self._writing.add(video_id)
+        try:
+            return AudioCacheWriter(self, video_id, self._path(video_id) + '.part',
+                                    data.get('title'), data.get('duration'))
+        except OSError as e:
+            print(f"Audio cache write error: {e}")
+            with self._lock:
+                self._writing.discard(video_id)
+            return None
+
+    def finish(self, writer, keep):
+        size = 0
+        try:
+            if keep:
+                os.replace(writer.path, self._path(writer.video_id))
+                size = os.path.getsize(self._path(writer.video_id))
+            else:
+                os.remove(writer.path)
+        except OSError as e:
+            print(f"Audio cache error: {e}")
+            keep = False
+
+        with self._lock:
+            self._writing.discard(writer.video_id)
+            if keep:
+                self._index[writer.video_id] = [size, time.time(), 0, writer.title, writer.duration]
+            victims = self._evict()
+        self._remove(victims)
+        if keep or victims:
+            self._save_index()
+
+    def submit(self, fn):
+        try:
+            self._executor.submit(fn)
+        except RuntimeError:
+            fn()  # Shut down already
+
+    def save_used(self):
+        """Save the index if only use counts and times changed since the last save (blocking)"""
+        if self._used:
+            self._save_index()
+
+    async def run(self):
+        """Save use counts periodically, started from setup_hook"""
+        while True:
+            await asyncio.sleep(AUDIO_CACHE_INDEX_INTERVAL)
+            await asyncio.get_running_loop().run_in_executor(self._executor, self.save_used)
+
+    def close(self):
+        """Finish pending recordings and save the index, called at shutdown"""
+        self._executor.shutdown(wait=True)
+        if self.directory:
+            self.save_used()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'files': len(self._index),
+                'bytes': sum(entry[0] for entry in self._index.values()),
+                'max_bytes': self.max_bytes,
+            }
+
+    def _path(self, video_id):
+        return os.path.join(self.directory, f"{video_id}.opk")
+
+    def _evict(self):
+        """Drop index entries until the budget fits, returns the files to delete"""
+        total = sum(entry[0] for entry in self._index.values())
+        if total <= self.max_bytes:
+            return []
+        if self.policy == 'lfu':
+            order = sorted(self._index, key=lambda k: (self._index[k][2], self._index[k][1]))
+        else:
+            order = sorted(self._index, key=lambda k: self._index[k][1])
+        victims = []
+        for video_id in order:
+            if total <= self.max_bytes:
+                break
+            total -= self._index.pop(video_id)[0]
+            victims.append(self._path(video_id))
+        return victims
+
+    def _remove(self, paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                # Still open for playback on Windows, the next eviction retries
+                pass
+
+    def _scan(self):
+        saved = {}
+        try:
+            with open(os.path.join(self.directory, 'index.json'), encoding='utf-8') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.part'):
+                # Left behind by a crash mid-recording
+                self._remove([path])
+            elif name.endswith('.opk'):
+                video_id = name[:-4]
+                last_used, hits, title, duration = saved.get(video_id, (os.path.getmtime(path), 0, None, None))
+                self._index[video_id] = [os.path.getsize(path), last_used, hits, title, duration]
+        self._remove(self._evict())
+
+    def _save_index(self):
+        with self._lock:
+            snapshot = {video_id: entry[1:] for video_id, entry in self._index.items()}
+            self._used = False
+        path = os.path.join(self.directory, 'index.json')
+        try:
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            print(f"Audio cache index write error: {e}")
+
+audio_cache = AudioCache(AUDIO_CACHE_DIR or None, AUDIO_CACHE_MAX_MB * 1024 * 1024, AUDIO_CACHE_POLICY)
+
+class CachedOpusSource(discord.AudioSource):
+    """Plays packets recorded by the audio cache, without FFmpeg or network"""
+
+    def __init__(self, path, data, start=0):
+        self.data = data
+        self.title = data.get('title')
+        self.url = None
+        self._file = open(path, 'rb')
+        if self._file.read(len(AUDIO_CACHE_MAGIC)) != AUDIO_CACHE_MAGIC:
+            self._file.close()
+            raise ValueError(f"Not an audio cache file: {path}")
+        # Seek by skipping whole packets, each one is a frame
+        for _ in range(int(start / FRAME_SECONDS)):
+            header = self._file.read(2)
+            if len(header) < 2:
+                break
+            self._file.seek(int.from_bytes(header, 'big'), os.SEEK_CUR)
+
+    def read(self):
+        header = self._file.read(2)
+        if len(header) < 2:
+            return b''
+        return self._file.read(int.from_bytes(header, 'big'))
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self._file.close()
+
+class DecodedOpusSource(discord.AudioSource):
+    """Decodes an Opus source to PCM so PCMVolumeTransformer can scale it"""
+
+    def __init__(self, original):
+        self.original = original
+        self._decoder = discord.opus.Decoder()
+
+    def read(self):
+        packet = self.original.read()
+        # Recordings made before the headers were dropped still start with them
+        while packet and is_opus_header(packet):
+            packet = self.original.read()
+        return self._decoder.decode(packet) if packet else b''
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        self.original.cleanup()
+
+def create_cached_source(path, track, guild_id=None, start=0):
+    """Build an audio source that replays a track from the local audio cache"""
+    data = {'id': track.id, 'title': track.title, 'duration': track.duration}
+    source = CachedOpusSource(path, data, start)
+    gain = loudness.gain(track.id)
+    volume = get_volume(guild_id) * gain
+    if volume == 1.0 and AUDIO_MODE != 'pcm':
+        return source
+    # Recordings are at full volume, other levels need the decode/scale path
+    return YTDLSource(DecodedOpusSource(source), data=data, volume=volume, gain=gain)
+
+def is_opus_stream(data):
+    """Whether the resolved stream can be copied without re-encoding.
+
+    Uses the codec yt-dlp already reported instead of spawning ffprobe per track.
+    """
+    return data.get('acodec') == 'opus'
+
+# Loudness normalization settings
+LOUDNESS_NORMALIZATION = os.getenv("LOUDNESS_NORMALIZATION", "on").lower() == "on"
+LOUDNESS_TARGET = float(os.getenv("LOUDNESS_TARGET", "-14"))  # Integrated loudness songs are brought to, in LUFS
+LOUDNESS_MAX_BOOST = 6.0  # dB; quiet songs aren't raised further, to avoid clipping
+LOUDNESS_MIN_GAIN = float(os.getenv("LOUDNESS_MIN_GAIN", "1"))  # dB; smaller corrections keep Opus passthrough
+LOUDNESS_MAX_SONGS = int(os.getenv("LOUDNESS_MAX_SONGS", "10000"))  # Measurements kept, the oldest are dropped
+LOUDNESS_ANALYZE_SECONDS = 180  # Audio spooled per song for measuring (about 2 MB on disk at 96 kbps)
+LOUDNESS_MIN_SECONDS = 30  # Songs skipped sooner than this aren't measured
+LOUDNESS_PENDING_MAX = 4  # Songs being sampled or waiting for a measurement, more are skipped until later
+LOUDNESS_RE = re.compile(r'Integrated loudness:\s+I:\s+(-?[\d.]+) LUFS')
+
+# Ogg's CRC-32 is zlib's polynomial without the bit reflection, so bytes are
+# mirrored going into zlib.crc32 and the result is mirrored back
+OGG_BIT_REVERSE = bytes(int(f'{i:08b}'[::-1], 2) for i in range(256))
+
+def ogg_page(serial, sequence, granule, packets, flags=0):
+    """One Ogg page holding whole packets"""
+    lacing = bytearray()
+    for packet in packets:
+        lacing.extend(b'\xff' * (len(packet) // 255))
+        lacing.append(len(packet) % 255)
+    header = struct.pack('<4sBBqIII', b'OggS', 0, flags, granule, serial, sequence, 0) + bytes([len(lacing)]) + lacing
+    page = header + b''.join(packets)
+    crc = zlib.crc32(page.translate(OGG_BIT_REVERSE), 0xffffffff) ^ 0xffffffff
+    return page[:22] + int(f'{crc:032b}'[::-1], 2).to_bytes(4, 'little') + page[26:]
+
+OGG_PACKETS_PER_PAGE = 40  # An Opus packet needs at most 6 of a page's 255 lacing values
+
+class LoudnessSample:
+    """Opus packets of a song as it plays, spooled to a temporary Ogg file so its loudness can be measured afterwards.
+
+    Packets go to disk a page at a time, so a sample holds at most
+    OGG_PACKETS_PER_PAGE of them in memory however long the song is.
+    """
+
+    def __init__(self, video_id, volume):
+        self.video_id = video_id
+        self.volume = volume  # Volume the packets were encoded at, taken back out of the result
+        self.packets = 0  # Audio packets spooled, not counting the stream headers
+        self.complete = False  # Set when the source hit EOF rather than being stopped
+        self._page = []  # Packets of the Ogg page being filled
+        self._sequence = 0
+        self._file = tempfile.TemporaryFile(prefix='loudness-')
+
+    def write(self, packet):
+        if self._file is None or self.packets * FRAME_SECONDS >= LOUDNESS_ANALYZE_SECONDS:
+            return
+        if self._sequence < len(OPUS_HEADERS):
+            # discord.py hands on FFmpeg's OpusHead and OpusTags packets as the
+            # first two "frames", they start the stream as they are
+            if packet[:8] != OPUS_HEADERS[self._sequence]:
+                self.discard()
+                return
+            self._write_page([packet], flags=2 if self._sequence == 0 else 0)
+            return
+        self._page.append(packet)
+        self.packets += 1
+        if len(self._page) == OGG_PACKETS_PER_PAGE:
+            self._write_page(self._page)
+            self._page = []
+
+    def _write_page(self, packets, flags=0):
+        try:
+            self._file.write(ogg_page(1, self._sequence, self.packets * 960, packets, flags))
+            self._sequence += 1
+        except OSError as e:
+            print(f"Loudness sample write error: {e}")
+            self.discard()
+
+    def stream(self):
+        """End the Ogg stream and return the file rewound for reading, None if the sample was dropped (blocking)"""
+        if self._page:
+            self._write_page(self._page, flags=4)
+            self._page = []
+        if self._file is None:
+            return None
+        self._file.seek(0)
+        return self._file
+
+    def discard(self):
+        """Close and delete the spool file"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+class LoudnessCache:
+    """Integrated loudness of songs, measured once and applied as a fixed gain.
+
+    A song is measured from the Opus packets of its first play, so nothing is
+    downloaded twice. The packets are spooled to a temporary Ogg file as they
+    play, and when that play ends the file goes through a low-priority FFmpeg
+    ebur128 pass, one song at a time. Results are kept in the state database,
+    the newest LOUDNESS_MAX_SONGS of them.
+
+    Playback folds the gain into the volume it already applies, so there is
+    no per-frame analysis. The catch is that a corrected song no longer
+    qualifies for Opus passthrough: FFmpeg decodes and re-encodes it, and it
+    isn't recorded into the audio cache. Corrections under LOUDNESS_MIN_GAIN
+    are skipped to keep most songs on the copy path.
+    """
+
+    def __init__(self):
+        self.levels = OrderedDict()  # video_id -> LUFS, oldest measurement first
+        self.pending = set()  # Songs being sampled or measured
+        self.measured = 0
+        self.failed = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='loudness')
+
+    async def load(self):
+        self.levels.update(await state_store.load_loudness(LOUDNESS_MAX_SONGS))
+
+    def gain(self, video_id):
+        """Volume factor that brings a song to LOUDNESS_TARGET, 1.0 when unknown or close enough"""
+        lufs = self.levels.get(video_id) if LOUDNESS_NORMALIZATION else None
+        if lufs is None:
+            return 1.0
+        gain_db = min(LOUDNESS_TARGET - lufs, LOUDNESS_MAX_BOOST)
+        if abs(gain_db) < LOUDNESS_MIN_GAIN:
+            return 1.0
+        return round(10 ** (gain_db / 20), 3)
+
+    def sample(self, video_id, volume):
+        """Start sampling a song that is about to play, None if it is known or already sampled"""
+        if (not LOUDNESS_NORMALIZATION or not video_id or volume <= 0 or video_id in self.levels
+                or video_id in self.pending or len(self.pending) >= LOUDNESS_PENDING_MAX):
+            return None
+        try:
+            sample = LoudnessSample(video_id, volume)
+        except OSError as e:
+            print(f"Could not start a loudness sample: {e}")
+            return None
+        self.pending.add(video_id)
+        return sample
+
+    def finish(self, sample):
+        """Measure a finished sample in the background, called on the event loop"""
+        if not sample.complete and sample.packets * FRAME_SECONDS < LOUDNESS_MIN_SECONDS or not sample.packets:
+            sample.discard()
+            self.pending.discard(sample.video_id)
+            return
+        bot.loop.create_task(self.measure(sample))
+
+    async def measure(self, sample):
+        try:
+            lufs = await asyncio.get_running_loop().run_in_executor(self._executor, self.analyze, sample)
+        finally:
+            sample.discard()
+            self.pending.discard(sample.video_id)
+        if lufs is None:
+            self.failed += 1
+            return
+        # The packets were encoded at the volume of that play
+        lufs = round(lufs - 20 * math.log10(sample.volume), 1)
+        self.measured += 1
+        self.levels[sample.video_id] = lufs
+        while len(self.levels) > LOUDNESS_MAX_SONGS:
+            self.levels.popitem(last=False)
+        await state_store.save_loudness(sample.video_id, lufs, LOUDNESS_MAX_SONGS)
+        log_event('loudness', video_id=sample.video_id, lufs=lufs)
+
+    def analyze(self, sample):
+        """Integrated loudness of a sample in LUFS, or None if FFmpeg couldn't tell (blocking)"""
+        spool = sample.stream()
+        if spool is None:
+            return None
+        try:
+            process = subprocess.Popen(
+                [FFMPEG_EXECUTABLE, '-hide_banner', '-nostats', '-threads', '1', '-f', 'ogg', '-i', 'pipe:0',
+                 '-af', 'ebur128=framelog=verbose', '-f', 'null', '-'],
+                stdin=spool, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                # Playback comes first
+                preexec_fn=(lambda: os.nice(10)) if hasattr(os, 'nice') else None)
+        except OSError as e:
+            print(f"Could not start FFmpeg to measure loudness: {e}")
+            return None
+        stderr = process.communicate()[1]
+        match = LOUDNESS_RE.search(stderr.decode(errors='replace'))
+        if process.returncode != 0 or match is None:
+            return None
+        lufs = float(match.group(1))
+        return lufs if lufs > -70 else None  # Silence gates everything out
+
+loudness = LoudnessCache()
+
+def seek_options(start):
+    """FFmpeg before_options that also seek the input to start seconds"""
+    if not start:
+        return ffmpeg_options['before_options']
+    return f"{ffmpeg_options['before_options']} -ss {start:.2f}"
+
+def create_source(data, guild_id=None, start=0):
+    """Build the audio source for resolved stream info, starting start seconds in"""
+    gain = loudness.gain(data.get('id'))
+    volume = get_volume(guild_id) * gain
+    tier = governor.tier_for(guild_id)
+    stream = select_stream(data, tier)
+    if AUDIO_MODE == 'pcm':
+        audio = discord.FFmpegPCMAudio(stream['url'], executable=FFMPEG_EXECUTABLE,
+                                       before_options=seek_options(start), options=ffmpeg_options['options'])
+        return YTDLSource(audio, data=stream, volume=volume, gain=gain, tier=tier)
+    # Only complete plays of the default format are worth keeping in the audio cache
+    return YTDLOpusSource(stream, volume=volume, tier=tier, record=stream is data and not start, start=start)
+
+class YTDLOpusSource(discord.FFmpegOpusAudio):
+    """Opus source with the volume fixed at creation time.
+
+    At 100% volume an Opus stream is remuxed with -c:a copy, so there is no
+    decode, no Python-side scaling and no libopus encode. Otherwise FFmpeg
+    applies the volume filter and encodes to Opus itself.
+    """
+
+    def __init__(self, data, *, volume=1.0, tier=QUALITY_TIERS[1], record=True, start=0):
+        self.data = data
+        self.title = data.get('title')
+        self.url = data.get('url')
+        self.volume = volume
+        self.tier = tier
+        self.passthrough = volume == 1.0 and is_opus_stream(data)
+        # Partial plays and mono downmixes don't tell a song's loudness
+        sample = not start and tier.channels == 2
+        self._loudness = loudness.sample(data.get('id'), volume) if sample else None
+
+        if self.passthrough:
+            options = '-vn'
+        else:
+            options = f'-vn -af volume={volume:.2f} -compression_level {tier.compression}'
+            if tier.channels != 2:
+                # discord.py already asks for stereo, the last -ac wins
+                options += f' -ac {tier.channels}'
+        super().__init__(
+            self.url,
+            executable=FFMPEG_EXECUTABLE,
+            # discord.py treats 'libopus' like 'opus' and copies, None makes it encode
+            codec='copy' if self.passthrough else None,
+            bitrate=tier.bitrate,
+            before_options=seek_options(start),
+            options=options,
+        )
+        # Only untouched streams are recorded, so replays can apply any volume
+        self._recorder = audio_cache.record(data) if self.passthrough and record else None
+
+    def read(self):
+        packet = super().read()
+        for tap in (self._recorder, self._loudness):
+            if tap is not None:
+                if packet:
+                    tap.write(packet)
+                else:
+                    tap.complete = True
+        return packet
+
+    def cleanup(self):
+        super().cleanup()
+        # Also reached from __del__ when FFmpeg failed to start
+        recorder = getattr(self, '_recorder', None)
+        if recorder is not None:
+            self._recorder = None
+            recorder.close()
+        sample = getattr(self, '_loudness', None)
+        if sample is not None:
+            self._loudness = None
+            try:
+                bot.loop.call_soon_threadsafe(loudness.finish, sample)
+            except (AttributeError, RuntimeError):
+                sample.discard()  # The client isn't running (anymore), so neither is the loop
+
+class YTDLSource(discord.PCMVolumeTransformer):
+    def __init__(self, source, *, data, volume=0.5, gain=1.0, tier=None):
+        # gain is the song's loudness correction, volume already includes it
+        super().__init__(source, volume)
+        self.gain = gain
+        self.tier = tier  # Quality tier the stream was picked for, None for cached replays
+        self.data = data
+        self.title = data.get('title')
+        self.url = data.get('url')
+
+    @classmethod
+    async def resolve(cls, url, *, guild_id=None, priority=PRIORITY_INTERACTIVE, requester_id=None, failed_url=None):
+        """Get stream info for a URL, served from the extraction cache when fresh.
+
+        failed_url is a stream URL that stopped working; cached info using it is
+        extracted again.
+        """
+        key = cache_key(url)
+        if failed_url:
+            extraction_cache.discard(key, failed_url)
+        data, stale = extraction_cache.get(key)
+        if data is None:
+            # Concurrent requests for the same video share one extraction
+            data = await extractor.run(
+                lambda: extraction_cache.fetch(key, lambda: extract_track(url), stale),
+                key=key, guild_id=guild_id, priority=priority, requester_id=requester_id)
+        return data
+
+    @classmethod
+    async def from_url(cls, url, *, stream=False, guild_id=None, requester_id=None):
+        if stream:
+            data = await cls.resolve(url, guild_id=guild_id, requester_id=requester_id)
+        else:
+            data = await extractor.run(lambda: get_ytdl().extract_info(url, download=True),
+                                       guild_id=guild_id, requester_id=requester_id)
+            if 'entries' in data:
+                # Take first item from a playlist
+                data = data['entries'][0]
+
+        if stream:
+            return create_source(data, guild_id)
+
+        filename = get_ytdl().prepare_filename(data)
+        return cls(discord.FFmpegPCMAudio(filename, executable=FFMPEG_EXECUTABLE, **ffmpeg_options), data=data, volume=get_volume(guild_id))
+
+class Track:
+    """A queued song.
+
+    Slotted so long queues stay small; metadata known at enqueue time (e.g.
+    from flat playlist entries) is kept so /queue never has to extract.
+    """
+    __slots__ = ('id', 'url', 'title', 'duration', 'requester_id', 'source')
+
+    def __init__(self, url, *, id=None, title=None, duration=None, requester_id=None):
+        self.id = id or video_id(url)
+        self.url = url
+        self.title = title
+        self.duration = duration
+        self.requester_id = requester_id
+        self.source = None  # Resolved stream info once prefetched
+
+    @classmethod
+    def from_entry(cls, entry, requester_id=None):
+        """Build a track from a flat playlist entry"""
+        duration = entry.get('duration')
+        return cls(playlist_entry_url(entry), id=entry.get('id'), title=entry.get('title'),
+                   duration=int(duration) if duration else None, requester_id=requester_id)
+
+    def update(self, data):
+        """Fill in metadata from resolved stream info"""
+        self.id = data.get('id') or self.id
+        self.title = data.get('title') or self.title
+        if data.get('duration'):
+            self.duration = int(data['duration'])
+
+    def row(self):
+        """The track's columns in the state database"""
+        return self.url, self.id, self.title, self.duration, self.requester_id
+
+    @classmethod
+    def from_row(cls, row):
+        url, track_id, title, duration, requester_id = row
+        return cls(url, id=track_id, title=title, duration=duration, requester_id=requester_id)
+
+    @property
+    def display_title(self):
+        return self.title or self.url
+
+def format_duration(seconds):
+    if not seconds:
+        return "?:??"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+# Guild player settings
+HISTORY_SIZE = int(os.getenv("HISTORY_SIZE", "50"))  # Played songs remembered for Prev
+PLAYER_IDLE_TIMEOUT = int(os.getenv("PLAYER_IDLE_TIMEOUT", "1800"))  # Evict a disconnected guild from memory after 30 min
+EMPTY_CHANNEL_TIMEOUT = int(os.getenv("EMPTY_CHANNEL_TIMEOUT", "120"))  # Leave a voice channel with no listeners
+
+class GuildPlayer:
+    """Playback state of one guild.
+
+    Owns the queue, a bounded history ring buffer, the loop flag, volume and
+    the background tasks working for the guild. Evicting the guild cancels the
+    tasks and drops the history; the persisted state is kept.
+    """
+
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.queue = deque()
+        self.history = deque(maxlen=HISTORY_SIZE)
+        self.loop = False
+        self.volume = None  # None = DEFAULT_VOLUME
+        self.quality = None  # Tier name set with /quality, None = governor decides
+        self.current = None  # Track that is playing
+        self.channels = None  # (voice_channel_id, text_channel_id) while playing
+        self.prefetch = None  # (track, task) resolving the head of the queue
+        self.prewarm = None  # (track, source) of the next song, built before the current one ends
+        self.playlist_import = None  # Task streaming a playlist into the queue
+        self.empty_timer = None  # Task that leaves an empty voice channel
+        self.leaving = False  # Set while disconnecting so play_next doesn't start another track
+        self.ended_at = None  # perf_counter() when the last track finished, for the transition gap
+        self.stream_retries = 0  # Times the current track's stream was resumed after breaking off
+        self.now_playing = None  # (text_channel_id, message_id) of the now-playing message
+        self.now_playing_channel = None  # Text channel a new now-playing message goes to
+        self.now_playing_task = None  # Task editing the message, see update_now_playing
+        self.now_playing_pending = False
+        self.last_active = time.monotonic()
+
+    @property
+    def voice_client(self):
+        return discord.utils.get(bot.voice_clients, guild__id=self.guild_id)
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def is_idle(self, now):
+        """Disconnected, not importing and unused for PLAYER_IDLE_TIMEOUT"""
+        if self.voice_client is not None or self.playlist_import is not None:
+            return False
+        return now - self.last_active >= PLAYER_IDLE_TIMEOUT
+
+    def reset(self):
+        """Clear the queue and cancel all background work for the guild"""
+        self.queue.clear()
+        self.loop = False
+        cancel_prefetch(self.guild_id)
+        drop_prewarm(self.guild_id)
+        cancel_playlist_import(self.guild_id)
+        extractor.cancel_guild(self.guild_id)
+        playback_stopped(self.guild_id)
+
+    def close(self):
+        """Cancel the background work, the queue and settings are left as they are"""
+        cancel_prefetch(self.guild_id)
+        drop_prewarm(self.guild_id)
+        cancel_playlist_import(self.guild_id)
+        extractor.cancel_guild(self.guild_id)
+        self.history.clear()
+        for task in (self.empty_timer, self.now_playing_task):
+            if task is not None:
+                task.cancel()
+        self.empty_timer = self.now_playing_task = None
+
+    def state(self):
+        """What is persisted for the guild, in the shape StateStore.load_guild returns"""
+        return {
+            'loop': self.loop,
+            'volume': self.volume,
+            'quality': self.quality,
+            'channels': self.channels,
+            'now_playing': self.now_playing,
+            'current': self.current,
+            'queue': self.queue,
+        }
+
+    def apply_state(self, state):
+        """Take over saved state; the interrupted track goes back to the front"""
+        self.queue = state['queue']
+        if state['current'] is not None:
+            self.queue.appendleft(state['current'])
+        self.loop = state['loop']
+        self.volume = state['volume']
+        self.quality = state['quality']
+        self.channels = state['channels']
+        self.now_playing = state['now_playing']
+
+DORMANT_MAX = 200  # Evicted guilds whose state is kept in memory when there is no STATE_DB
+
+players = {}  # guild_id -> GuildPlayer
+dormant = OrderedDict()  # guild_id -> state of evicted guilds without STATE_DB, oldest first
+
+def get_player(guild_id):
+    guild_player = players.get(guild_id)
+    if guild_player is None:
+        state = saved_state(guild_id)
+        dormant.pop(guild_id, None)
+        guild_player = players[guild_id] = GuildPlayer(guild_id)
+        if state is not None:
+            guild_player.apply_state(state)
+    guild_player.touch()
+    return guild_player
+
+def saved_state(guild_id, queue=True):
+    """State of a guild that isn't in memory, None if it has none; queue=False skips reading the tracks"""
+    if state_store.path:
+        return state_store.load_guild(guild_id, queue)
+    return dormant.get(guild_id)
+
+def guild_setting(guild_id, name):
+    """A guild's loop, volume or quality, read without bringing an evicted guild back into memory"""
+    guild_player = players.get(guild_id)
+    if guild_player is not None:
+        return getattr(guild_player, name)
+    state = saved_state(guild_id, queue=False)
+    return state[name] if state is not None else None
+
+def remove_player(guild_id):
+    """Drop a guild's player from memory.
+
+    The saved queue, volume and quality stay in the database, so the guild
+    picks them up again when it next plays. Without a database the newest
+    DORMANT_MAX evicted guilds keep them in memory.
+    """
+    guild_player = players.get(guild_id)
+    if guild_player is None:
+        return
+    guild_player.close()
+    state_store.detach(guild_id)
+    if not state_store.path and snapshot_guild(guild_id) is not None:
+        dormant[guild_id] = guild_player.state()
+        while len(dormant) > DORMANT_MAX:
+            dormant.popitem(last=False)
+    del players[guild_id]
+
+def get_queue(guild_id):
+    return get_player(guild_id).queue
+
+def get_loop_state(guild_id):
+    return bool(guild_setting(guild_id, 'loop'))
+
+def set_loop_state(guild_id, state):
+    get_player(guild_id).loop = state
+    save_state(guild_id)
+
+def get_volume(guild_id):
+    volume = guild_setting(guild_id, 'volume')
+    return DEFAULT_VOLUME if volume is None else volume
+
+def set_volume(guild_id, level):
+    get_player(guild_id).volume = level
+    save_state(guild_id)
+
+def get_history(guild_id):
+    return get_player(guild_id).history
+
+@metrics.collector('musicbot_queue_depth')
+def collect_queue_depth():
+    return [({'guild': guild_id}, len(guild_player.queue)) for guild_id, guild_player in players.items()]
+
+class MeteredSource(discord.AudioSource):
+    """Wraps a track's source to time its first packet and count frames played.
+
+    Also sums the read latency (time spent waiting on the inner source for a
+    frame) and counts frames asked for more than a frame late, which the
+    quality governor reads as load signals. discord.py encodes PCM frames after
+    read() returns, so that encode is not part of the read latency.
+    """
+
+    def __init__(self, inner, guild_id, requested_at, metric, start=0):
+        self.inner = inner
+        self.guild_id = guild_id
+        self.requested_at = requested_at
+        self.metric = metric
+        self.start = start  # Seconds into the track the source begins
+        self.ended = False  # The source ran out, as opposed to being stopped
+        self.frames = 0
+        self.late_frames = 0
+        self.read_time = 0.0  # Seconds spent in inner.read(), not the encode after it
+        self.next_due = None  # When the player should ask for the next frame
+
+    @property
+    def title(self):
+        return self.inner.title
+
+    @property
+    def data(self):
+        return self.inner.data
+
+    @property
+    def position(self):
+        """Seconds into the track played so far"""
+        return self.start + self.frames * FRAME_SECONDS
+
+    def read(self):
+        now = time.perf_counter()
+        if self.next_due is not None:
+            lateness = now - self.next_due
+            if lateness > 1.0:
+                # Paused and resumed, the player starts a new schedule too
+                self.next_due = now
+            elif lateness > FRAME_SECONDS:
+                self.late_frames += 1
+        self.next_due = (self.next_due or now) + FRAME_SECONDS
+
+        packet = self.inner.read()
+        self.read_time += time.perf_counter() - now
+        if self.frames == 0 and packet:
+            seconds = time.perf_counter() - self.requested_at
+            metrics.observe(self.metric, seconds)
+            log_event('first_audio', guild=self.guild_id, kind=self.metric, seconds=round(seconds, 3))
+        if packet:
+            self.frames += 1
+        else:
+            self.ended = True
+        return packet
+
+    def is_opus(self):
+        return self.inner.is_opus()
+
+    def cleanup(self):
+        self.inner.cleanup()
+
+# Quality governor settings
+QUALITY_GOVERNOR = os.getenv("QUALITY_GOVERNOR", "on").lower() == "on"
+QUALITY_MAX = os.getenv("QUALITY_MAX", "normal").lower()  # Best tier the governor goes back up to
+GOVERNOR_INTERVAL = 5  # Seconds between load samples
+GOVERNOR_CPU_HIGH = float(os.getenv("GOVERNOR_CPU_HIGH", "0.85"))  # System CPU share that counts as overloaded
+GOVERNOR_CPU_LOW = float(os.getenv("GOVERNOR_CPU_LOW", "0.6"))  # ...and as calm enough to step back up
+LATE_FRAMES_HIGH = 0.02  # Share of frames sent late
+LATE_FRAMES_LOW = 0.002
+READ_MS_HIGH = 5.0  # Average read latency in milliseconds per frame (of the 20 available)
+READ_MS_LOW = 2.0
+STEP_DOWN_SAMPLES = 2  # Overloaded samples in a row before lowering quality (10s)
+STEP_UP_SAMPLES = 12  # Calm samples in a row before raising it again (60s)
+
+def read_cpu_times():
+    """(busy, total) jiffies of all CPUs from /proc/stat, or None where that isn't available"""
+    try:
+        with open("/proc/stat") as f:
+            fields = [int(x) for x in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    idle = fields[3] + (fields[4] if len(fields) > 4 else 0)  # idle + iowait
+    return sum(fields) - idle, sum(fields)
+
+class QualityGovernor:
+    """Picks the quality tier for new streams from system load.
+
+    Every GOVERNOR_INTERVAL it samples system CPU and, from the playing
+    sources, the average read latency per frame and the share of late
+    frames. Sustained overload lowers quality one tier, a longer calm period
+    raises it one tier again. Guilds with a /quality override keep theirs.
+    """
+
+    def __init__(self, ceiling):
+        self.ceiling = ceiling  # Index of the best tier allowed
+        self.level = ceiling
+        self.sources = weakref.WeakSet()
+        self.cpu = None
+        self.late_ratio = 0.0
+        self.read_ms = 0.0
+        self._last = weakref.WeakKeyDictionary()  # source -> counters at the previous sample
+        self._cpu_times = read_cpu_times()
+        self._overloaded = 0
+        self._calm = 0
+
+    @property
+    def tier(self):
+        return QUALITY_TIERS[self.level]
+
+    def tier_for(self, guild_id):
+        quality = guild_setting(guild_id, 'quality')
+        if quality in QUALITY_TIER_INDEX:
+            return QUALITY_TIERS[QUALITY_TIER_INDEX[quality]]
+        return self.tier
+
+    def watch(self, source):
+        self.sources.add(source)
+
+    def sample(self):
+        cpu_times = read_cpu_times()
+        if cpu_times and self._cpu_times and cpu_times[1] > self._cpu_times[1]:
+            self.cpu = (cpu_times[0] - self._cpu_times[0]) / (cpu_times[1] - self._cpu_times[1])
+        self._cpu_times = cpu_times
+
+        frames = late = 0
+        read_time = 0.0
+        for source in list(self.sources):
+            last_frames, last_late, last_read = self._last.get(source, (0, 0, 0.0))
+            frames += source.frames - last_frames
+            late += source.late_frames - last_late
+            read_time += source.read_time - last_read
+            self._last[source] = (source.frames, source.late_frames, source.read_time)
+        self.late_ratio = late / frames if frames else 0.0
+        self.read_ms = read_time / frames * 1000 if frames else 0.0
+
+        overloaded = ((self.cpu or 0) >= GOVERNOR_CPU_HIGH or self.late_ratio >= LATE_FRAMES_HIGH
+                      or self.read_ms >= READ_MS_HIGH)
+        calm = ((self.cpu or 0) <= GOVERNOR_CPU_LOW and self.late_ratio <= LATE_FRAMES_LOW
+                and self.read_ms <= READ_MS_LOW)
+        self._overloaded = self._overloaded + 1 if overloaded else 0
+        self._calm = self._calm + 1 if calm else 0
+
+        if self._overloaded >= STEP_DOWN_SAMPLES and self.level < len(QUALITY_TIERS) - 1:
+            self.change(self.level + 1)
+        elif self._calm >= STEP_UP_SAMPLES and self.level > self.ceiling:
+            self.change(self.level - 1)
+
+    def change(self, level):
+        old = self.tier
+        self.level = level
+        self._overloaded = self._calm = 0
+        print(f"Quality {old.name} -> {self.tier.name} (cpu {self.cpu or 0:.0%}, "
+              f"late frames {self.late_ratio:.1%}, read {self.read_ms:.1f} ms/frame)")
+        log_event('quality_change', old=old.name, new=self.tier.name, cpu=round(self.cpu or 0, 3),
+                  late_ratio=round(self.late_ratio, 4), read_ms=round(self.read_ms, 2))
+
+    async def run(self):
+        """Sample load forever, started from setup_hook"""
+        while True:
+            await asyncio.sleep(GOVERNOR_INTERVAL)
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"Quality governor error: {e}")
+
+governor = QualityGovernor(QUALITY_TIER_INDEX.get(QUALITY_MAX, 1))
+
+@metrics.collector('musicbot_quality_tier')
+def collect_quality_tier():
+    return [({'tier': governor.tier.name}, governor.level)]
+
+@metrics.collector('musicbot_system_cpu_ratio')
+def collect_system_cpu():
+    return [({}, governor.cpu)] if governor.cpu is not None else []
+
+@metrics.collector('musicbot_late_frame_ratio')
+def collect_late_frames():
+    return [({}, governor.late_ratio)]
+
+def ffmpeg_process_of(source):
+    """Find the FFmpeg process behind a (possibly wrapped) source"""
+    while source is not None:
+        process = getattr(source, '_process', None)
+        if process:
+            return process
+        # discord.py's wrappers keep the source in .original, MeteredSource in .inner
+        source = getattr(source, 'original', None) or getattr(source, 'inner', None)
+    return None
+
+# Stream recovery settings
+STREAM_RETRIES = int(os.getenv("STREAM_RETRIES", "3"))  # Resumes per track after its stream broke off
+RESUME_MARGIN = 5.0  # A stream ending this close to the track's end counts as finished
+
+def stream_broke_off(track, metered, error):
+    """Whether a network stream stopped well before the end of the track (expired URL, 403, ...)"""
+    if not (metered.ended or error) or not getattr(metered.inner, 'url', None):
+        return False  # Stopped on purpose, or played from the audio cache
+    return bool(track.duration) and metered.position < track.duration - RESUME_MARGIN
+
+def start_playback(guild_id, track, source, voice_client, channel, requested_at=None, start=0):
+    """Play a track's source from start seconds in and continue with play_next when it ends"""
+    guild_player = get_player(guild_id)
+    if requested_at is None:
+        # Started by play_next, measure the gap since the previous track ended
+        requested_at = guild_player.ended_at or time.perf_counter()
+        metric = 'musicbot_transition_gap_seconds'
+    else:
+        metric = 'musicbot_first_audio_seconds'
+    if not start:
+        guild_player.stream_retries = 0
+
+    def after(error):
+        guild_player.ended_at = time.perf_counter()
+        if error:
+            print(f"Player error: {error}")
+        if stream_broke_off(track, metered, error) and guild_player.stream_retries < STREAM_RETRIES:
+            guild_player.stream_retries += 1
+            next_step = resume_track(guild_id, track, metered.position, metered.inner.url, channel)
+        else:
+            next_step = play_next(guild_id, channel)
+        asyncio.run_coroutine_threadsafe(next_step, bot.loop)
+
+    metered = MeteredSource(source, guild_id, requested_at, metric, start)
+    governor.watch(metered)
+    # The bitrate only matters when discord.py encodes (PCM sources)
+    voice_client.play(metered, after=after, bitrate=governor.tier_for(guild_id).bitrate)
+    process = ffmpeg_supervisor.adopt(source, guild_id)
+    track_started(guild_id, track, voice_client, channel)
+    log_event('track_start', guild=guild_id, title=track.display_title, cached=process is None)
+
+async def resume_track(guild_id, track, position, failed_url, channel):
+    """Continue a track whose stream broke off, from a fresh stream URL at the same position"""
+    voice_client = discord.utils.get(bot.voice_clients, guild__id=guild_id)
+    if not voice_client or get_player(guild_id).leaving:
+        return
+    print(f"Stream of {track.display_title} broke off at {format_duration(position)}, resuming")
+    metrics.inc('musicbot_stream_resumes_total')
+    log_event('stream_resume', guild=guild_id, title=track.display_title, position=round(position, 1))
+    try:
+        source = await load_track_at(guild_id, track, position, failed_url)
+    except Exception as e:
+        print(f"Could not resume {track.display_title}: {e}")
+        await play_next(guild_id, channel)
+        return
+    if voice_client.is_playing() or voice_client.is_paused() or not voice_client.is_connected():
+        # Something else started meanwhile, or the bot left
+        source.cleanup()
+        return
+    start_playback(guild_id, track, source, voice_client, channel, start=position)
+
+def playback_position(guild_id):
+    """Seconds into the current track, or None when nothing of ours is playing"""
+    voice_client = discord.utils.get(bot.voice_clients, guild__id=guild_id)
+    source = voice_client.source if voice_client else None
+    if not isinstance(source, MeteredSource) or get_player(guild_id).current is None:
+        return None
+    return source.position
+
+def restart_at(guild_id, track, source, voice_client, channel, position):
+    """Swap the playing source for one of the same track starting at position (/seek, /volume)"""
+    # No await between stop and play, so the stopped source's after= leaves the queue alone
+    if voice_client.is_playing() or voice_client.is_paused():
+        voice_client.stop()
+    get_player(guild_id).stream_retries = 0
+    start_playback(guild_id, track, source, voice_client, channel, time.perf_counter(), start=position)
+
+def track_started(guild_id, track, voice_client, channel):
+    """Remember what a guild is playing and where, so playback can resume after a restart"""
+    guild_player = get_player(guild_id)
+    guild_player.current = track
+    guild_player.channels = (voice_client.channel.id, channel.id)
+    save_state(guild_id)
+    title_index.add(track.id, track.title, track.duration)
+    update_now_playing(guild_id, channel)
+
+def playback_stopped(guild_id):
+    guild_player = players.get(guild_id)
+    if guild_player is not None:
+        guild_player.current = None
+        guild_player.channels = None
+        save_state(guild_id)
+        update_now_playing(guild_id)
+
+async def disconnect_player(guild_player):
+    """Leave voice, keeping the queue; the interrupted track goes back to the front"""
+    voice_client = guild_player.voice_client
+    if voice_client is None:
+        return
+    if guild_player.current is not None and (voice_client.is_playing() or voice_client.is_paused()):
+        guild_player.queue.appendleft(guild_player.current)
+    cancel_prefetch(guild_player.guild_id)
+    drop_prewarm(guild_player.guild_id)
+    playback_stopped(guild_player.guild_id)
+    guild_player.leaving = True
+    try:
+        await voice_client.disconnect()
+    finally:
+        guild_player.leaving = False
+
+async def leave_empty_channel(guild_player):
+    await asyncio.sleep(EMPTY_CHANNEL_TIMEOUT)
+    guild_player.empty_timer = None
+    voice_client = guild_player.voice_client
+    if voice_client and not any(not member.bot for member in voice_client.channel.members):
+        print(f"Leaving empty voice channel in guild {guild_player.guild_id}")
+        await disconnect_player(guild_player)
+
+def check_empty_channel(guild_player, voice_client):
+    """Start or cancel the timer that leaves a voice channel without listeners"""
+    listeners = any(not member.bot for member in voice_client.channel.members)
+    if listeners and guild_player.empty_timer is not None:
+        guild_player.empty_timer.cancel()
+        guild_player.empty_timer = None
+    elif not listeners and guild_player.empty_timer is None:
+        guild_player.empty_timer = bot.loop.create_task(leave_empty_channel(guild_player))
+
+async def evict_idle_players():
+    """Periodically evict guilds that have been disconnected and unused for a while"""
+    while True:
+        await asyncio.sleep(60)
+        now = time.monotonic()
+        for guild_id, guild_player in list(players.items()):
+            if guild_player.is_idle(now):
+                remove_player(guild_id)
+
+# Persistence settings
+STATE_DB = os.getenv("STATE_DB", "bot_state.db")  # Empty = keep state in memory only
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "2"))  # Seconds between batched writes
+
+class StateStore:
+    """Write-behind persistence of guild playback state in SQLite (WAL mode).
+
+    Changes only mark a guild dirty. Every STATE_FLUSH_INTERVAL seconds the
+    dirty guilds are snapshotted on the event loop and written in a single
+    transaction on a dedicated thread, so enqueueing never waits on disk.
+    Track rows keep their positions while songs are played and appended, so
+    a flush only writes the rows that changed. A guild's state is read when
+    it is first used, not at startup.
+    """
+
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS guilds (
+            guild_id INTEGER PRIMARY KEY,
+            loop INTEGER NOT NULL DEFAULT 0,
+            volume REAL,
+            voice_channel_id INTEGER,
+            text_channel_id INTEGER,
+            quality TEXT,
+            now_playing_channel_id INTEGER,
+            now_playing_message_id INTEGER,
+            queue_start INTEGER NOT NULL DEFAULT 0
+        )""",
+        # Positions from the guild's queue_start on hold the queue, the one just
+        # before it the track that was playing
+        """CREATE TABLE IF NOT EXISTS tracks (
+            guild_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            url TEXT NOT NULL,
+            video_id TEXT,
+            title TEXT,
+            duration INTEGER,
+            requester_id INTEGER,
+            PRIMARY KEY (guild_id, position)
+        ) WITHOUT ROWID""",
+        # Small values that aren't guild state, like the synced command tree hash
+        """CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )""",
+        # Measured integrated loudness per song, see LoudnessCache
+        """CREATE TABLE IF NOT EXISTS loudness (
+            video_id TEXT PRIMARY KEY,
+            lufs REAL NOT NULL,
+            measured_at REAL NOT NULL DEFAULT 0
+        ) WITHOUT ROWID""",
+    )
+
+    ADDED_COLUMNS = (
+        ('guilds', 'quality', 'TEXT'),
+        ('guilds', 'now_playing_channel_id', 'INTEGER'),
+        ('guilds', 'now_playing_message_id', 'INTEGER'),
+        ('loudness', 'measured_at', 'REAL NOT NULL DEFAULT 0'),
+        ('guilds', 'queue_start', 'INTEGER NOT NULL DEFAULT 0'),
+    )
+
+    SHIFT_SCAN = 16  # Songs looked at for how far the queue start moved between writes
+
+    def __init__(self, path):
+        self.path = path
+        self._dirty = set()
+        self._detached = {}  # guild_id -> snapshot taken as the guild left memory
+        self._writing = {}  # Snapshot being written, newer than what the database holds
+        self._conn = None
+        self._reader = None  # Connection for the point reads of load_guild, on the event loop
+        self._layouts = {}  # guild_id -> (queue_start, current hash, queue hashes) as last written
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='state')
+
+    def mark_dirty(self, guild_id):
+        if self.path:
+            self._dirty.add(guild_id)
+
+    def detach(self, guild_id):
+        """Snapshot a guild about to be evicted, so its pending changes are still written"""
+        if guild_id in self._dirty:
+            self._dirty.discard(guild_id)
+            self._detached[guild_id] = snapshot_guild(guild_id)
+
+    async def playing_guilds(self):
+        """Guilds that were in a voice channel when the bot stopped"""
+        if not self.path:
+            return []
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._playing_guilds)
+
+    def load_guild(self, guild_id, queue=True):
+        """Saved state of one guild, None if it has none.
+
+        A blocking point read by primary key, made on the event loop so
+        get_player can stay synchronous. Snapshots not written yet take
+        precedence over the database.
+        """
+        if not self.path:
+            return None
+        for pending in (self._detached, self._writing):
+            if guild_id in pending:
+                return self._state(*pending[guild_id]) if pending[guild_id] is not None else None
+        try:
+            if self._reader is None:
+                self._reader = sqlite3.connect(self.path, check_same_thread=False)
+            return self._read_guild(self._reader, guild_id, queue)
+        except sqlite3.Error as e:
+            print(f"State read error for guild {guild_id}: {e}")
+            return None
+
+    async def get_meta(self, key):
+        if not self.path:
+            return None
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._get_meta, key)
+
+    async def set_meta(self, key, value):
+        if self.path:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._set_meta, key, value)
+
+    async def load_loudness(self, limit):
+        """The newest measured song loudness, [(video_id, LUFS)] oldest first"""
+        if not self.path:
+            return []
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._load_loudness, limit)
+
+    async def save_loudness(self, video_id, lufs, limit):
+        """Store a measurement and drop the oldest beyond limit"""
+        if self.path:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._save_loudness, video_id, lufs, limit)
+
+    async def run(self):
+        """Flush dirty guilds forever, started from setup_hook"""
+        while True:
+            await asyncio.sleep(STATE_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"State flush error: {e}")
+
+    async def flush(self):
+        snapshot = self._snapshot()
+        if snapshot:
+            self._writing = snapshot
+            try:
+                await asyncio.get_running_loop().run_in_executor(self._executor, self._write, snapshot)
+            finally:
+                self._writing = {}
+
+    def close(self):
+        """Write what is still dirty, called after the event loop has stopped"""
+        snapshot = self._snapshot()
+        self._executor.shutdown(wait=True)
+        if snapshot:
+            self._write(snapshot)
+        for conn in (self._conn, self._reader):
+            if conn is not None:
+                conn.close()
+        self._conn = self._reader = None
+
+    def _snapshot(self):
+        snapshot, self._detached = self._detached, {}
+        # Evicted guilds keep their rows, only a guild in memory can change them
+        snapshot.update((guild_id, snapshot_guild(guild_id)) for guild_id in self._dirty if guild_id in players)
+        self._dirty.clear()
+        return snapshot
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            for statement in self.SCHEMA:
+                self._conn.execute(statement)
+            # Databases from older versions lack the newer columns
+            for table, column, kind in self.ADDED_COLUMNS:
+                columns = {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {kind}")
+        return self._conn
+
+    def _write(self, snapshot):
+        conn = self._connect()
+        layouts = {}
+        try:
+            with conn:
+                for guild_id, state in snapshot.items():
+                    if state is None:
+                        conn.execute("DELETE FROM tracks WHERE guild_id = ?", (guild_id,))
+                        conn.execute("DELETE FROM guilds WHERE guild_id = ?", (guild_id,))
+                        layouts[guild_id] = None
+                        continue
+                    guild_row, current, queue = state
+                    layouts[guild_id] = layout = self._write_tracks(conn, guild_id, current, queue)
+                    conn.execute("INSERT OR REPLACE INTO guilds (guild_id, loop, volume, voice_channel_id, "
+                                 "text_channel_id, quality, now_playing_channel_id, now_playing_message_id, "
+                                 "queue_start) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", guild_row + (layout[0],))
+        except Exception:
+            # The rows on disk are unknown again, the next write starts over
+            for guild_id in snapshot:
+                self._layouts.pop(guild_id, None)
+            raise
+        self._layouts.update(layouts)
+        # Evicted guilds start over if they come back, rather than keep their layout in memory
+        for guild_id in [guild_id for guild_id, layout in self._layouts.items()
+                         if layout is None or guild_id not in players]:
+            del self._layouts[guild_id]
+
+    def _write_tracks(self, conn, guild_id, current, queue):
+        """Write the track rows that changed since the last write, returns the new layout"""
+        hashes = [hash(row) for row in queue]
+        current_hash = hash(current) if current is not None else None
+        layout = self._layouts.get(guild_id)
+        if layout is None:
+            conn.execute("DELETE FROM tracks WHERE guild_id = ?", (guild_id,))
+            old_start, old_current, old_hashes = 0, None, []
+            start = 0
+        else:
+            old_start, old_current, old_hashes = layout
+            start = old_start + self._shift(old_hashes, hashes)
+            conn.execute("DELETE FROM tracks WHERE guild_id = ? AND (position < ? OR position >= ?)",
+                         (guild_id, start - 1 if current is not None else start, start + len(queue)))
+
+        def written(position):
+            index = position - old_start
+            if index == -1:
+                return old_current
+            return old_hashes[index] if 0 <= index < len(old_hashes) else None
+
+        rows = []
+        if current is not None and written(start - 1) != current_hash:
+            rows.append((guild_id, start - 1) + current)
+        rows.extend((guild_id, start + i) + row for i, row in enumerate(queue) if written(start + i) != hashes[i])
+        conn.executemany("INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        return start, current_hash, hashes
+
+    def _shift(self, old, new):
+        """How far the queue start moved: songs taken off the front (positive) or put back on it (negative)"""
+        if not old or not new:
+            return 0
+        if new[0] in old[:self.SHIFT_SCAN]:
+            return old.index(new[0])
+        if old[0] in new[:self.SHIFT_SCAN]:
+            return -new.index(old[0])
+        return 0
+
+    def _get_meta(self, key):
+        row = self._connect().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        conn = self._connect()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    def _load_loudness(self, limit):
+        rows = self._connect().execute("SELECT video_id, lufs FROM loudness ORDER BY measured_at DESC LIMIT ?",
+                                       (limit,)).fetchall()
+        return rows[::-1]
+
+    def _save_loudness(self, video_id, lufs, limit):
+        conn = self._connect()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO loudness (video_id, lufs, measured_at) VALUES (?, ?, ?)",
+                         (video_id, lufs, time.time()))
+            conn.execute("DELETE FROM loudness WHERE video_id NOT IN "
+                         "(SELECT video_id FROM loudness ORDER BY measured_at DESC LIMIT ?)", (limit,))
+
+    def _playing_guilds(self):
+        rows = self._connect().execute("SELECT guild_id FROM guilds WHERE voice_channel_id IS NOT NULL")
+        return [row[0] for row in rows]
+
+    def _read_guild(self, conn, guild_id, queue=True):
+        guild_row = conn.execute("SELECT guild_id, loop, volume, voice_channel_id, text_channel_id, quality, "
+                                 "now_playing_channel_id, now_playing_message_id, queue_start "
+                                 "FROM guilds WHERE guild_id = ?", (guild_id,)).fetchone()
+        if guild_row is None:
+            return None
+        start = guild_row[-1]
+        current, rows = None, []
+        if queue:
+            for row in conn.execute("SELECT position, url, video_id, title, duration, requester_id "
+                                    "FROM tracks WHERE guild_id = ? ORDER BY position", (guild_id,)):
+                if row[0] >= start:
+                    rows.append(row[1:])
+                else:
+                    current = row[1:]
+        return self._state(guild_row[:-1], current, rows)
+
+    @staticmethod
+    def _state(guild_row, current, queue):
+        """State dict from a guilds row and track rows, as read or as snapshot_guild builds them"""
+        _, loop, volume, voice_channel_id, text_channel_id, quality, np_channel_id, np_message_id = guild_row
+        return {
+            'loop': bool(loop),
+            'volume': volume,
+            'quality': quality,
+            'channels': (voice_channel_id, text_channel_id) if voice_channel_id else None,
+            'now_playing': (np_channel_id, np_message_id) if np_message_id else None,
+            'current': Track.from_row(current) if current is not None else None,
+            'queue': deque(Track.from_row(row) for row in queue),
+        }
+
+state_store = StateStore(STATE_DB)
+
+def save_state(guild_id):
+    state_store.mark_dirty(guild_id)
+
+def snapshot_guild(guild_id):
+    """Rows describing a guild's state, or None when there is nothing worth keeping"""
+    guild_player = players.get(guild_id)
+    if guild_player is None:
+        return None
+    queue = guild_player.queue
+    current = guild_player.current
+    if (not queue and current is None and not guild_player.loop and guild_player.volume is None
+            and guild_player.quality is None and guild_player.now_playing is None):
+        return None
+
+    voice_channel_id, text_channel_id = guild_player.channels or (None, None)
+    np_channel_id, np_message_id = guild_player.now_playing or (None, None)
+    guild_row = (guild_id, int(guild_player.loop), guild_player.volume, voice_channel_id, text_channel_id,
+                 guild_player.quality, np_channel_id, np_message_id)
+    return guild_row, current.row() if current is not None else None, [track.row() for track in queue]
+
+async def restore_state():
+    """Load the guilds that were playing so they can resume, the others are loaded when first used"""
+    # Sharded workers share the database, each one takes its own guilds
+    guild_ids = [guild_id for guild_id in await state_store.playing_guilds() if owns_guild(guild_id)]
+    for guild_id in guild_ids:
+        get_player(guild_id)
+    if guild_ids:
+        print(f"Restored state of {len(guild_ids)} playing guild(s)")
+
+async def resume_playback():
+    """Rejoin the voice channels that were playing before the restart"""
+    for guild_id, guild_player in list(players.items()):
+        if guild_player.channels is None:
+            continue
+        voice_channel_id, text_channel_id = guild_player.channels
+        guild = bot.get_guild(guild_id)
+        voice_channel = guild.get_channel(voice_channel_id) if guild else None
+        text_channel = guild.get_channel_or_thread(text_channel_id) if guild else None
+        if not voice_channel or not text_channel or not any(not m.bot for m in voice_channel.members):
+            # Nobody to play for, keep the queue but don't rejoin
+            playback_stopped(guild_id)
+            continue
+        try:
+            if guild.voice_client is None:
+                await voice_channel.connect()
+            await play_next(guild_id, text_channel)
+        except Exception as e:
+            print(f"Could not resume playback in guild {guild_id}: {e}")
+
+# Background resolution of the next queued track
+def schedule_prefetch(guild_id):
+    """Resolve the head of the guild's queue while the current track is still playing"""
+    guild_player = get_player(guild_id)
+    if not guild_player.queue:
+        cancel_prefetch(guild_id)
+        return
+
+    track = guild_player.queue[0]
+    pending = guild_player.prefetch
+    if pending and pending[0] is track:
+        return
+
+    cancel_prefetch(guild_id)
+    prewarmed = guild_player.prewarm
+    if track.source is not None or audio_cache.contains(track.id) or (prewarmed and prewarmed[0] is track):
+        return
+    task = bot.loop.create_task(YTDLSource.resolve(track.url, guild_id=guild_id, priority=PRIORITY_BACKGROUND))
+    task.add_done_callback(partial(_prefetch_done, track))
+    guild_player.prefetch = (track, task)
+
+def _prefetch_done(track, task):
+    if task.cancelled():
+        return
+    if task.exception():
+        # play_next resolves again and reports the error to the channel
+        print(f"Prefetch error: {task.exception()}")
+        return
+    track.source = task.result()
+    track.update(track.source)
+
+def cancel_prefetch(guild_id):
+    """Drop the prefetch for a guild, e.g. after the queue was cleared or reordered"""
+    guild_player = players.get(guild_id)
+    if guild_player is None:
+        return
+    pending, guild_player.prefetch = guild_player.prefetch, None
+    if pending and not pending[1].done():
+        pending[1].cancel()
+
+# FFmpeg supervision settings
+FFMPEG_PER_GUILD = int(os.getenv("FFMPEG_PER_GUILD", "2"))  # Playing track plus the pre-warmed next one
+FFMPEG_NICE = int(os.getenv("FFMPEG_NICE", "0"))  # Niceness added to FFmpeg processes, 0 = unchanged
+FFMPEG_CPUS = {int(cpu) for cpu in os.getenv("FFMPEG_CPUS", "").split(",") if cpu.strip()}  # Empty = any CPU
+FFMPEG_MAX_MEMORY_MB = int(os.getenv("FFMPEG_MAX_MEMORY_MB", "0"))  # Address space limit per process, 0 = none
+# Kept next to the state database, one per worker (named after its first shard)
+FFMPEG_PIDFILE = os.getenv("FFMPEG_PIDFILE", (STATE_DB or "bot") + (f".ffmpeg-{SHARD_IDS[0]}.pids" if SHARD_IDS else ".ffmpeg.pids"))
+PREWARM_SECONDS = float(os.getenv("PREWARM_SECONDS", "10"))  # Start the next song's FFmpeg this long before the end, 0 = off
+SUPERVISOR_INTERVAL = 1.0  # Seconds between sweeps
+
+def process_start_time(pid):
+    """Start time of a process in clock ticks since boot (/proc/<pid>/stat field 22), None if unknown"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return int(f.read().rsplit(')', 1)[1].split()[19])
+    except (OSError, IndexError, ValueError):
+        return None
+
+class FFmpegSupervisor:
+    """Keeps the FFmpeg processes behind playback sources in check.
+
+    discord.py spawns FFmpeg itself, so limits are applied right after the
+    spawn: niceness, CPU affinity and an address space limit where the OS
+    supports them. A guild can own at most FFMPEG_PER_GUILD processes. A
+    sweep every second reaps processes that exited, kills the ones whose
+    source was dropped without cleanup, and pre-warms the next song. Live
+    pids are kept in a pidfile so a crashed run's leftovers are killed at
+    the next start.
+    """
+
+    def __init__(self, pidfile):
+        self.pidfile = pidfile
+        self.sources = {}  # pid -> weakref to the source owning the process
+        self.start_times = {}  # pid -> start time from /proc, tells a reused pid apart
+        self.killed = 0
+
+    def adopt(self, source, guild_id):
+        """Register the process behind a freshly created source, returns it (None for cached sources)"""
+        process = ffmpeg_process_of(source)
+        if process is None or process.pid in ffmpeg_processes:
+            return process
+        self.limit(process.pid)
+        ffmpeg_processes[process.pid] = (guild_id, process)
+        self.sources[process.pid] = weakref.ref(source)
+        self.start_times[process.pid] = process_start_time(process.pid)
+        self.enforce(guild_id, keep=process.pid)
+        self.write_pidfile()
+        return process
+
+    def limit(self, pid):
+        try:
+            if FFMPEG_NICE and hasattr(os, 'setpriority'):
+                os.setpriority(os.PRIO_PROCESS, pid, os.getpriority(os.PRIO_PROCESS, pid) + FFMPEG_NICE)
+            if FFMPEG_CPUS and hasattr(os, 'sched_setaffinity'):
+                os.sched_setaffinity(pid, FFMPEG_CPUS)
+            if FFMPEG_MAX_MEMORY_MB and hasattr(resource, 'prlimit'):
+                limit = FFMPEG_MAX_MEMORY_MB * 1048576
+                resource.prlimit(pid, resource.RLIMIT_AS, (limit, limit))
+        except OSError as e:
+            print(f"Could not limit FFmpeg process {pid}: {e}")
+
+    def enforce(self, guild_id, keep):
+        """Kill a guild's oldest processes beyond FFMPEG_PER_GUILD, never the one playing"""
+        pids = [pid for pid, (owner, process) in ffmpeg_processes.items()
+                if owner == guild_id and process.poll() is None]
+        if len(pids) <= FFMPEG_PER_GUILD:
+            return
+        voice_client = discord.utils.get(bot.voice_clients, guild__id=guild_id)
+        playing = ffmpeg_process_of(voice_client.source) if voice_client else None
+        spare = [pid for pid in pids if pid != keep and (playing is None or pid != playing.pid)]
+        for pid in spare[:len(pids) - FFMPEG_PER_GUILD]:
+            guild_player = players.get(guild_id)
+            if guild_player is not None and guild_player.prewarm and guild_player.prewarm[1] is not None \
+                    and ffmpeg_process_of(guild_player.prewarm[1]) is ffmpeg_processes[pid][1]:
+                drop_prewarm(guild_id)
+            self.kill(pid)
+            print(f"Guild {guild_id} is over its FFmpeg limit, stopped process {pid}")
+
+    def kill(self, pid):
+        entry = ffmpeg_processes.pop(pid, None)
+        self.sources.pop(pid, None)
+        self.start_times.pop(pid, None)
+        if entry is None:
+            return
+        process = entry[1]
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+            self.killed += 1
+
+    def sweep(self):
+        """Forget exited processes (reaping zombies) and kill those no source owns anymore"""
+        changed = False
+        for pid, (guild_id, process) in list(ffmpeg_processes.items()):
+            if process.poll() is not None:
+                del ffmpeg_processes[pid]
+                self.sources.pop(pid, None)
+                self.start_times.pop(pid, None)
+                changed = True
+            elif pid in self.sources and self.sources[pid]() is None:
+                print(f"Killing orphaned FFmpeg process {pid}")
+                self.kill(pid)
+                changed = True
+        if changed:
+            self.write_pidfile()
+
+    def write_pidfile(self):
+        if not self.pidfile:
+            return
+        try:
+            with open(self.pidfile, 'w') as f:
+                f.write(''.join(f"{pid} {self.start_times.get(pid)}\n" for pid in ffmpeg_processes))
+        except OSError as e:
+            print(f"Could not write {self.pidfile}: {e}")
+
+    def reap_leftovers(self):
+        """Kill FFmpeg processes a crashed earlier run left behind (now children of init).
 
-# Optimized FFmpeg options for Raspberry Pi Zero 2W
-ffmpeg_options = {
-    'options': '-vn -b:a 96k -ac 2',  # 96kbps, stereo (lower bitrate = less CPU)
-    'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
-}
+        A pid is only killed if the process still has the start time recorded
+        for it, so a pid reused by an unrelated process is left alone.
+        """
+        if not self.pidfile:
+            return
+        try:
+            with open(self.pidfile) as f:
+                entries = [line.split() for line in f]
+        except OSError:
+            return
+        for entry in entries:
+            if len(entry) != 2 or not entry[0].isdigit() or not entry[1].isdigit():
+                continue  # Start time unknown, can't tell it is still ours
+            pid, started = int(entry[0]), int(entry[1])
+            try:
+                with open(f"/proc/{pid}/cmdline", 'rb') as f:
+                    command = f.read().split(b'\0')[0]
+                with open(f"/proc/{pid}/stat") as f:
+                    parent = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue  # Gone already, or no /proc to check it with
+            if (os.path.basename(command).startswith(b'ffmpeg') and parent == 1
+                    and process_start_time(pid) == started):
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                    print(f"Killed FFmpeg process {pid} left over from the last run")
+                except OSError:
+                    pass
+        self.write_pidfile()
 
-ytdl = yt_dlp.YoutubeDL(ytdl_format_options)
-ytdl_playlist = yt_dlp.YoutubeDL(ytdl_playlist_options)
+    def close(self):
+        """Stop every process still running, called at shutdown"""
+        for pid in list(ffmpeg_processes):
+            self.kill(pid)
+        if self.pidfile:
+            try:
+                os.remove(self.pidfile)
+            except OSError:
+                pass
 
-class YTDLSource(discord.PCMVolumeTransformer):
-    def __init__(self, source, *, data, volume=0.5):
-        super().__init__(source, volume)
-        self.data = data
-        self.title = data.get('title')
-        self.url = data.get('url')
+    async def run(self):
+        while True:
+            await asyncio.sleep(SUPERVISOR_INTERVAL)
+            try:
+                self.sweep()
+                if PREWARM_SECONDS:
+                    schedule_prewarms()
+            except Exception as e:
+                print(f"FFmpeg supervisor error: {e}")
 
-    @classmethod
-    async def from_url(cls, url, *, loop=None, stream=False):
-        loop = loop or asyncio.get_event_loop()
-        data = await loop.run_in_executor(None, lambda: ytdl.extract_info(url, download=not stream))
+ffmpeg_supervisor = FFmpegSupervisor(FFMPEG_PIDFILE)
 
-        if 'entries' in data:
-            # Take first item from a playlist
-            data = data['entries'][0]
+def schedule_prewarms():
+    """Start the next song's FFmpeg for guilds whose current song is about to end"""
+    for guild_id, guild_player in list(players.items()):
+        track = guild_player.current
+        if guild_player.prewarm is not None or not guild_player.queue or guild_player.loop or track is None:
+            continue
+        voice_client = guild_player.voice_client
+        source = voice_client.source if voice_client else None
+        if not isinstance(source, MeteredSource) or not track.duration:
+            continue
+        if track.duration - source.position <= PREWARM_SECONDS:
+            next_track = guild_player.queue[0]
+            if next_track.id and audio_cache.contains(next_track.id):
+                continue  # Replayed from disk, nothing to warm up
+            guild_player.prewarm = (next_track, None)  # Loading
+            bot.loop.create_task(prewarm(guild_player, next_track))
 
-        filename = data['url'] if stream else ytdl.prepare_filename(data)
-        return cls(discord.FFmpegPCMAudio(filename, **ffmpeg_options), data=data)
+async def prewarm(guild_player, track):
+    """Build the source of the next song early, so FFmpeg has connected and buffered when it starts"""
+    guild_id = guild_player.guild_id
+    try:
+        source = await load_track(guild_id, track)
+    except Exception as e:
+        print(f"Prewarm error: {e}")
+        if guild_player.prewarm is not None and guild_player.prewarm[0] is track:
+            guild_player.prewarm = None
+        return
+    if guild_player.prewarm is None or guild_player.prewarm[0] is not track:
+        source.cleanup()  # Dropped while loading
+        return
+    guild_player.prewarm = (track, source)
+    ffmpeg_supervisor.adopt(source, guild_id)
 
-# Queue system and playback state
-queues = {}
-loop_state = {}
-history = {}
+def take_prewarmed(guild_id, track):
+    """The pre-warmed source for track if it is still usable, else None"""
+    guild_player = get_player(guild_id)
+    prewarmed, guild_player.prewarm = guild_player.prewarm, None
+    if prewarmed is None or prewarmed[1] is None:
+        return None
+    prewarmed_track, source = prewarmed
+    process = ffmpeg_process_of(source)
+    if prewarmed_track is track and matches_settings(source, guild_id) and (process is None or process.poll() is None):
+        return source
+    source.cleanup()
+    return None
 
-def get_queue(guild_id):
-    if guild_id not in queues:
-        queues[guild_id] = []
-    return queues[guild_id]
+def matches_settings(source, guild_id):
+    """Whether a source built earlier has the volume, loudness gain and quality tier a new one would get"""
+    gain = loudness.gain(source.data.get('id'))
+    tier = governor.tier_for(guild_id)
+    # The volume filter is written with two decimals, a closer match makes no difference
+    return (round(getattr(source, 'volume', 1.0), 2) == round(get_volume(guild_id) * gain, 2)
+            and getattr(source, 'tier', None) in (None, tier))
 
-def get_loop_state(guild_id):
-    return loop_state.get(guild_id, False)
+def drop_prewarm(guild_id):
+    guild_player = players.get(guild_id)
+    if guild_player is None:
+        return
+    prewarmed, guild_player.prewarm = guild_player.prewarm, None
+    if prewarmed is not None and prewarmed[1] is not None:
+        prewarmed[1].cleanup()
 
-def set_loop_state(guild_id, state):
-    loop_state[guild_id] = state
+async def resolve_next(guild_id, track, requester_id=None):
+    """Resolve a track, reusing the prefetch for it when there is one"""
+    guild_player = get_player(guild_id)
+    pending, guild_player.prefetch = guild_player.prefetch, None
+    if pending:
+        prefetched_track, task = pending
+        if prefetched_track is track:
+            try:
+                await task
+            except Exception:
+                pass
+        elif not task.done():
+            task.cancel()
 
-def get_history(guild_id):
-    if guild_id not in history:
-        history[guild_id] = []
-    return history[guild_id]
+    data, track.source = track.source, None
+    expiry = stream_expiry(data) if data else None
+    if data is None or (expiry and expiry - EXPIRE_MARGIN <= time.time()):
+        data = await YTDLSource.resolve(track.url, guild_id=guild_id, requester_id=requester_id)
+    track.update(data)
+    return data
+
+async def load_track_at(guild_id, track, start, failed_url=None):
+    """Source for a track beginning start seconds in, leaving the queue's prefetch alone"""
+    cached = audio_cache.lookup(track.id) if track.id else None
+    if cached:
+        try:
+            return create_cached_source(cached[0], track, guild_id, start)
+        except (OSError, ValueError) as e:
+            print(f"Audio cache read error: {e}")
+
+    data = await YTDLSource.resolve(track.url, guild_id=guild_id, failed_url=failed_url)
+    track.update(data)
+    return create_source(data, guild_id, start)
+
+async def load_track(guild_id, track, requester_id=None):
+    """Return an audio source for a track, replaying it from the audio cache when possible"""
+    cached = audio_cache.lookup(track.id) if track.id else None
+    if cached:
+        path, title, duration = cached
+        track.title = track.title or title
+        track.duration = track.duration or duration
+        try:
+            return create_cached_source(path, track, guild_id)
+        except (OSError, ValueError) as e:
+            print(f"Audio cache read error: {e}")
+
+    data = await resolve_next(guild_id, track, requester_id)
+    return create_source(data, guild_id)
 
 def is_youtube_playlist(url):
     """Check if URL is a YouTube playlist (not a single video from a playlist)"""
@@ -145,43 +2834,341 @@ def is_youtube_playlist(url):
     
     return False
 
-async def extract_playlist_urls(playlist_url):
-    """Extract all video URLs from a YouTube playlist (optimized for Pi)"""
-    loop = asyncio.get_event_loop()
-    
-    try:
-        # Use lazy extraction to reduce memory usage
-        data = await loop.run_in_executor(
-            None, 
-            lambda: ytdl_playlist.extract_info(playlist_url, download=False)
+# Playlist import settings
+MAX_QUEUE_LENGTH = int(os.getenv("MAX_QUEUE_LENGTH", "500"))  # Keeps queue memory bounded
+PLAYLIST_BATCH_SIZE = int(os.getenv("PLAYLIST_BATCH_SIZE", "25"))  # Entries fetched per background job
+PROGRESS_EDIT_INTERVAL = 2.0  # Seconds between progress message edits
+
+def playlist_entry_url(entry):
+    return entry.get('url') or entry.get('webpage_url') or f"https://www.youtube.com/watch?v={entry.get('id')}"
+
+async def iter_playlist(playlist_url, guild_id=None, requester_id=None):
+    """Yield (playlist title, batch of tracks) while the playlist is being paged in.
+
+    The first batch holds a single entry so playback can start right away,
+    the rest are fetched as background jobs on the extraction scheduler.
+    """
+    # The lazy entries generator keeps using the instance that created it from
+    # whichever worker runs the next page, so each import gets its own. It is
+    # built on the worker too, creating one takes a while.
+    def open_playlist():
+        import yt_dlp
+        ytdl = yt_dlp.YoutubeDL(ytdl_playlist_options)
+        return ytdl, timed_extract('playlist', lambda: ytdl.extract_info(playlist_url, download=False, process=False))
+
+    ytdl_playlist, data = await extractor.run(open_playlist, guild_id=guild_id, requester_id=requester_id)
+    if data.get('_type') == 'url':
+        # Redirected to another extractor, resolve it the regular way
+        data = await extractor.run(
+            lambda: timed_extract('playlist', lambda: ytdl_playlist.extract_info(data['url'], download=False)),
+            guild_id=guild_id, requester_id=requester_id
         )
-        
-        if 'entries' in data:
-            urls = []
-            # Limit playlist size to prevent overwhelming the Pi
-            max_songs = 50  # Safety limit for Pi Zero
-            for i, entry in enumerate(data['entries']):
-                if i >= max_songs:
+
+    title = data.get('title', 'Unknown Playlist')
+    entries = iter(data.get('entries') or ())
+    batch_size = 1
+    priority = PRIORITY_INTERACTIVE
+    while True:
+        batch = await extractor.run(
+            partial(lambda size: timed_extract('playlist_page', lambda: list(islice(entries, size))), batch_size),
+            guild_id=guild_id, priority=priority, requester_id=requester_id
+        )
+        if not batch:
+            return
+        yield title, [Track.from_entry(entry, requester_id) for entry in batch if entry]
+        batch_size = PLAYLIST_BATCH_SIZE
+        priority = PRIORITY_BACKGROUND
+
+async def import_playlist(guild_id, channel, playlist_url, requester_id, progress):
+    """Stream a playlist into the guild queue, editing one progress message as it goes"""
+    added = 0
+    title = None
+    status = None
+    last_edit = time.monotonic()
+
+    try:
+        async for title, tracks in iter_playlist(playlist_url, guild_id, requester_id):
+            queue = get_queue(guild_id)
+            for track in tracks:
+                if len(queue) >= MAX_QUEUE_LENGTH:
+                    status = f"⚠️ Queue is full ({MAX_QUEUE_LENGTH} songs), stopped importing"
                     break
-                if entry:
-                    url = entry.get('url') or entry.get('webpage_url') or f"https://www.youtube.com/watch?v={entry.get('id')}"
-                    urls.append(url)
-            return urls, data.get('title', 'Unknown Playlist')
+                queue.append(track)
+                added += 1
+            save_state(guild_id)
+
+            voice_client = discord.utils.get(bot.voice_clients, guild__id=guild_id)
+            if voice_client and not (voice_client.is_playing() or voice_client.is_paused()):
+                await play_next(guild_id, channel)
+            schedule_prefetch(guild_id)
+
+            if status:
+                break
+            if time.monotonic() - last_edit >= PROGRESS_EDIT_INTERVAL:
+                last_edit = time.monotonic()
+                try:
+                    await progress.edit(content=f"📝 Importing **{title}**... {added} songs added so far")
+                except discord.HTTPException as e:
+                    print(f"Could not update import progress: {e}")
+    except (asyncio.CancelledError, ExtractionCancelled):
+        status = "⏹️ Import cancelled"
     except Exception as e:
+        status = "❌ Could not extract playlist!" if not added else f"⚠️ Import stopped early: {e}"
         print(f"Playlist extraction error: {e}")
-    
-    return [], None
+    finally:
+        guild_player = players.get(guild_id)
+        if guild_player is not None and guild_player.playlist_import is asyncio.current_task():
+            guild_player.playlist_import = None
+
+    if title is None and status is None:
+        status = "❌ Could not extract playlist!"
+    summary = f"✅ Added **{added}** songs from playlist: **{title}**"
+    if status:
+        summary = f"{status}\n{summary}" if added else status
+    try:
+        await progress.edit(content=summary)
+    except discord.HTTPException as e:
+        print(f"Could not update import progress: {e}")
+
+def cancel_playlist_import(guild_id):
+    """Stop a running playlist import, returns True if there was one"""
+    guild_player = players.get(guild_id)
+    if guild_player is None:
+        return False
+    task, guild_player.playlist_import = guild_player.playlist_import, None
+    if task and not task.done():
+        task.cancel()
+        return True
+    return False
+
+# Broadcast settings
+BROADCAST_BUFFER_SECONDS = float(os.getenv("BROADCAST_BUFFER_SECONDS", "5"))  # Audio a listener may fall behind before skipping ahead
+BROADCAST_IDLE_TIMEOUT = float(os.getenv("BROADCAST_IDLE_TIMEOUT", "300"))  # Seconds a station plays without listeners before stopping
+BROADCAST_LEAD_FRAMES = 3  # Frames a new listener starts behind the live position, absorbs timer jitter
+BROADCAST_READ_TIMEOUT = 0.1  # Seconds a listener waits for a frame before sending silence
+OPUS_SILENCE = discord.opus.OPUS_SILENCE
+
+class BroadcastStation:
+    """One track stream shared by many guilds.
+
+    A pump thread reads the station's source once, at real time, into a ring
+    of Opus frames. Every listening guild plays a BroadcastListener that only
+    copies frames out of the ring, so a listener costs no FFmpeg process and
+    no encode. Between tracks the pump sends silence so listeners stay in step.
+    """
+
+    def __init__(self, name, owner_id):
+        self.name = name
+        self.owner_id = owner_id
+        self.queue = deque()
+        self.current = None  # Track being pumped
+        self.source = None
+        self.ring = [None] * max(BROADCAST_LEAD_FRAMES + 1, int(BROADCAST_BUFFER_SECONDS / FRAME_SECONDS))
+        self.seq = 0  # Sequence number of the next frame
+        self.cond = threading.Condition()
+        self.listeners = weakref.WeakSet()
+        self.finished = False  # No more tracks, the pump stops
+        self.ended = False  # Pump stopped, listeners drain and end
+        self.thread = None
+
+    @property
+    def oldest(self):
+        return max(0, self.seq - len(self.ring))
+
+    def frame(self, seq):
+        return self.ring[seq % len(self.ring)]
+
+    def push(self, packet):
+        with self.cond:
+            self.ring[self.seq % len(self.ring)] = packet
+            self.seq += 1
+            self.cond.notify_all()
+
+    def subscribe(self, guild_id):
+        listener = BroadcastListener(self, guild_id)
+        self.listeners.add(listener)
+        return listener
+
+    def start(self, source, track):
+        """Start pumping the first track"""
+        self.source, self.current = source, track
+        self.thread = threading.Thread(target=self.run, name=f"broadcast-{self.name}", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.finished = True
+
+    def run(self):
+        started = time.perf_counter()
+        frames = 0
+        idle_since = None
+        try:
+            while not self.finished:
+                source = self.source
+                packet = source.read() if source is not None else b''
+                if not packet:
+                    if source is not None:
+                        self.source = None
+                        self.close(source)
+                        asyncio.run_coroutine_threadsafe(self.advance(), bot.loop)
+                    packet = OPUS_SILENCE
+
+                self.push(packet)
+                frames += 1
+
+                if self.listeners:
+                    idle_since = None
+                elif idle_since is None:
+                    idle_since = time.monotonic()
+                elif time.monotonic() - idle_since > BROADCAST_IDLE_TIMEOUT:
+                    print(f"Broadcast {self.name} has no listeners, stopping")
+                    break
+
+                delay = started + frames * FRAME_SECONDS - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                elif delay < -1.0:
+                    # Stalled (e.g. a slow source), restart the schedule rather than burst
+                    started, frames = time.perf_counter(), 0
+        finally:
+            if self.source is not None:
+                self.close(self.source)
+                self.source = None
+            with self.cond:
+                self.ended = True
+                self.cond.notify_all()
+            bot.loop.call_soon_threadsafe(self.closed)
+
+    def close(self, source):
+        process = ffmpeg_process_of(source)
+        if process:
+            ffmpeg_processes.pop(process.pid, None)
+        source.cleanup()
+
+    async def advance(self):
+        """Load the next queued track into the pump, or finish the station"""
+        while self.queue and not self.finished:
+            track = self.queue.popleft()
+            try:
+                data = await YTDLSource.resolve(track.url, guild_id=self.owner_id, requester_id=track.requester_id)
+                track.update(data)
+                source = create_broadcast_source(data, self.owner_id)
+            except Exception as e:
+                print(f"Broadcast {self.name} could not load {track.display_title}: {e}")
+                continue
+            if self.finished:
+                source.cleanup()
+                return
+            self.current, self.source = track, source
+            for guild_id in {listener.guild_id for listener in list(self.listeners)}:
+                update_now_playing(guild_id)
+            log_event('broadcast_track', station=self.name, title=track.display_title, listeners=len(self.listeners))
+            return
+        self.current = None
+        self.finished = True
+
+    def closed(self):
+        if broadcasts.get(self.name) is self:
+            del broadcasts[self.name]
+        log_event('broadcast_end', station=self.name)
+
+class BroadcastListener(discord.AudioSource):
+    """A guild's view of a station: copies Opus frames out of the shared ring"""
+
+    def __init__(self, station, guild_id):
+        self.station = station
+        self.guild_id = guild_id
+        # Start at the live position, a few frames back so the two timers can drift
+        self.next_seq = max(station.oldest, station.seq - BROADCAST_LEAD_FRAMES)
+        self.data = {}
+
+    @property
+    def title(self):
+        current = self.station.current
+        return f"📻 {self.station.name}" + (f": {current.display_title}" if current else "")
+
+    def read(self):
+        station = self.station
+        with station.cond:
+            if self.next_seq < station.oldest:
+                # Fell out of the ring (paused or stalled), catch up to live
+                self.next_seq = max(station.oldest, station.seq - BROADCAST_LEAD_FRAMES)
+            if self.next_seq >= station.seq:
+                if station.ended:
+                    return b''
+                station.cond.wait(BROADCAST_READ_TIMEOUT)
+                if self.next_seq >= station.seq:
+                    return b'' if station.ended else OPUS_SILENCE
+            packet = station.frame(self.next_seq)
+            self.next_seq += 1
+            return packet
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.station.listeners.discard(self)
+
+# Stations by name, shared by every guild this process serves
+broadcasts = {}
+
+@metrics.collector('musicbot_broadcast_listeners')
+def collect_broadcast_listeners():
+    return [({'station': name}, len(station.listeners)) for name, station in list(broadcasts.items())]
+
+def create_broadcast_source(data, guild_id):
+    """A station's source: always Opus (copied when possible) at full volume, loudness-corrected"""
+    source = YTDLOpusSource(select_stream(data, governor.tier), volume=loudness.gain(data.get('id')),
+                            tier=governor.tier, record=False)
+    ffmpeg_supervisor.adopt(source, guild_id)
+    return source
+
+def listen_to_broadcast(guild_id, station, voice_client, channel, requested_at):
+    """Play a station in a guild, replacing what it was playing"""
+    listener = station.subscribe(guild_id)
+
+    def after(error):
+        get_player(guild_id).ended_at = time.perf_counter()
+        if error:
+            print(f"Player error: {error}")
+        asyncio.run_coroutine_threadsafe(play_next(guild_id, channel), bot.loop)
+
+    # Swap without awaiting in between, like /play-now
+    if voice_client.is_playing() or voice_client.is_paused():
+        voice_client.stop()
+    # The guild's own queue isn't playing; nothing to resume after a restart
+    playback_stopped(guild_id)
+    metered = MeteredSource(listener, guild_id, requested_at, 'musicbot_first_audio_seconds')
+    governor.watch(metered)
+    voice_client.play(metered, after=after)
+    update_now_playing(guild_id, channel)  # Shows the station
+    log_event('broadcast_join', guild=guild_id, station=station.name, listeners=len(station.listeners))
+    return listener
 
 # Music Control Buttons
 class MusicControlView(View):
-    def __init__(self, guild_id):
+    """Playback buttons of the now-playing message.
+
+    One instance is registered with add_view in setup_hook and handles the
+    buttons of every guild's message, also after a restart, so the guild
+    comes from the interaction. Messages are sent with stopped copies from
+    control_buttons() whose labels show the pause and loop state.
+    """
+
+    def __init__(self, paused=False, looping=False):
         super().__init__(timeout=None)
-        self.guild_id = guild_id
+        if paused:
+            self.pause_button.label = "▶️ Resume"
+            self.pause_button.style = discord.ButtonStyle.success
+        if looping:
+            self.loop_button.label = "🔁 Loop: On"
+            self.loop_button.style = discord.ButtonStyle.success
     
-    @discord.ui.button(label="⏮️ Prev", style=discord.ButtonStyle.secondary)
+    @discord.ui.button(label="⏮️ Prev", style=discord.ButtonStyle.secondary, custom_id="music:prev")
     async def prev_button(self, interaction: discord.Interaction, button: Button):
+        guild_id = interaction.guild.id
         voice_client = interaction.guild.voice_client
-        song_history = get_history(self.guild_id)
+        song_history = get_history(guild_id)
         
         if not voice_client:
             await interaction.response.send_message("I'm not in a voice channel!", ephemeral=True)
@@ -192,17 +3179,19 @@ class MusicControlView(View):
             return
         
         song_history.pop()
-        prev_url = song_history.pop()
+        prev_track = song_history.pop()
         
-        queue = get_queue(self.guild_id)
+        queue = get_queue(guild_id)
         if voice_client.is_playing():
             voice_client.stop()
         
-        queue.insert(0, prev_url)
+        queue.appendleft(prev_track)
+        save_state(guild_id)
+        schedule_prefetch(guild_id)
         voice_client.stop()
         await interaction.response.send_message("⏮️ Playing previous song...", ephemeral=True)
     
-    @discord.ui.button(label="⏭️ Next", style=discord.ButtonStyle.secondary)
+    @discord.ui.button(label="⏭️ Next", style=discord.ButtonStyle.secondary, custom_id="music:next")
     async def next_button(self, interaction: discord.Interaction, button: Button):
         voice_client = interaction.guild.voice_client
         
@@ -212,62 +3201,279 @@ class MusicControlView(View):
         else:
             await interaction.response.send_message("Nothing is playing!", ephemeral=True)
     
-    @discord.ui.button(label="⏸️ Pause", style=discord.ButtonStyle.primary)
+    @discord.ui.button(label="⏸️ Pause", style=discord.ButtonStyle.primary, custom_id="music:pause")
     async def pause_button(self, interaction: discord.Interaction, button: Button):
         voice_client = interaction.guild.voice_client
         
         if voice_client and voice_client.is_playing():
             voice_client.pause()
-            button.label = "▶️ Resume"
-            button.style = discord.ButtonStyle.success
-            await interaction.response.edit_message(view=self)
         elif voice_client and voice_client.is_paused():
             voice_client.resume()
-            button.label = "⏸️ Pause"
-            button.style = discord.ButtonStyle.primary
-            await interaction.response.edit_message(view=self)
         else:
             await interaction.response.send_message("Nothing is playing!", ephemeral=True)
+            return
+        content, view = now_playing_message(get_player(interaction.guild.id))
+        await interaction.response.edit_message(content=content, view=view)
     
-    @discord.ui.button(label="🔁 Loop: Off", style=discord.ButtonStyle.secondary)
+    @discord.ui.button(label="🔁 Loop: Off", style=discord.ButtonStyle.secondary, custom_id="music:loop")
     async def loop_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        current_state = get_loop_state(self.guild_id)
-        new_state = not current_state
-        set_loop_state(self.guild_id, new_state)
-        
-        if new_state:
-            button.label = "🔁 Loop: On"
-            button.style = discord.ButtonStyle.success
-        else:
-            button.label = "🔁 Loop: Off"
-            button.style = discord.ButtonStyle.secondary
-        
-        await interaction.response.edit_message(view=self)
+        guild_id = interaction.guild.id
+        set_loop_state(guild_id, not get_loop_state(guild_id))
+        content, view = now_playing_message(get_player(guild_id))
+        await interaction.response.edit_message(content=content, view=view)
     
-    @discord.ui.button(label="⏹️ Stop", style=discord.ButtonStyle.danger)
+    @discord.ui.button(label="⏹️ Stop", style=discord.ButtonStyle.danger, custom_id="music:stop")
     async def stop_button(self, interaction: discord.Interaction, button: Button):
         voice_client = interaction.guild.voice_client
         
         if voice_client:
-            queue = get_queue(self.guild_id)
-            queue.clear()
-            set_loop_state(self.guild_id, False)
+            get_player(interaction.guild.id).reset()
             voice_client.stop()
             await interaction.response.send_message("⏹️ Stopped and cleared queue", ephemeral=True)
         else:
             await interaction.response.send_message("I'm not in a voice channel!", ephemeral=True)
 
+# Rendered button sets by (paused, looping), there are only four
+button_views = {}
+
+def control_buttons(paused, looping):
+    view = button_views.get((paused, looping))
+    if view is None:
+        view = button_views[(paused, looping)] = MusicControlView(paused, looping)
+        # Only its components are sent; discord.py keeps no copy of a stopped view
+        # and clicks go to the registered instance
+        view.stop()
+    return view
+
+# Now-playing message settings
+NOW_PLAYING_INTERVAL = 1.5  # Min seconds between edits of a guild's now-playing message; updates in between are merged
+
+def broadcast_listener_of(voice_client):
+    """The BroadcastListener a voice client is playing, or None"""
+    source = getattr(voice_client, 'source', None)
+    listener = getattr(source, 'inner', source)
+    return listener if isinstance(listener, BroadcastListener) else None
+
+def now_playing_message(guild_player):
+    """(content, view) of a guild's now-playing message"""
+    track = guild_player.current
+    voice_client = guild_player.voice_client
+    paused = voice_client is not None and voice_client.is_paused()
+    if track is None:
+        listener = broadcast_listener_of(voice_client)
+        if listener is None:
+            return "⏹️ Nothing is playing", None
+        label = "⏸️ Paused" if paused else "Tuned in"
+        return f"{label}: **{listener.title}**", control_buttons(paused, guild_player.loop)
+    label = "🔁 Looping" if guild_player.loop else "⏸️ Paused" if paused else "Now playing"
+    content = f"{label}: **{track.display_title}**"
+    if track.duration:
+        content += f" ({format_duration(track.duration)})"
+    return content, control_buttons(paused, guild_player.loop)
+
+def update_now_playing(guild_id, channel=None):
+    """Bring the guild's now-playing message up to date, sending it to channel if there is none there yet.
+
+    The first update is sent right away; further ones within NOW_PLAYING_INTERVAL
+    are merged into a single edit, so a burst of skips costs one API call.
+    """
+    guild_player = players.get(guild_id)
+    if guild_player is None:
+        return
+    if channel is not None:
+        guild_player.now_playing_channel = channel
+    guild_player.now_playing_pending = True
+    if guild_player.now_playing_task is None:
+        guild_player.now_playing_task = bot.loop.create_task(refresh_now_playing(guild_player))
+
+async def refresh_now_playing(guild_player):
+    try:
+        while guild_player.now_playing_pending:
+            guild_player.now_playing_pending = False
+            try:
+                await render_now_playing(guild_player)
+            except discord.HTTPException as e:
+                print(f"Could not update now-playing message: {e}")
+            await asyncio.sleep(NOW_PLAYING_INTERVAL)
+    finally:
+        guild_player.now_playing_task = None
+
+async def render_now_playing(guild_player):
+    content, view = now_playing_message(guild_player)
+    channel = guild_player.now_playing_channel
+    if guild_player.now_playing is not None:
+        channel_id, message_id = guild_player.now_playing
+        if channel is None or channel.id == channel_id:
+            messageable = channel or bot.get_partial_messageable(channel_id)
+            try:
+                await messageable.get_partial_message(message_id).edit(content=content, view=view)
+                return
+            except discord.NotFound:
+                pass  # Deleted, send a new one
+        else:
+            # Playing from another text channel now, don't leave stale buttons behind
+            try:
+                await bot.get_partial_messageable(channel_id).get_partial_message(message_id).delete()
+            except discord.HTTPException:
+                pass
+        guild_player.now_playing = None
+        save_state(guild_player.guild_id)
+
+    if view is None or channel is None:
+        return  # Nothing playing and no message to update
+    message = await channel.send(content, view=view)
+    guild_player.now_playing = (channel.id, message.id)
+    save_state(guild_player.guild_id)
+
+def round_latency(latency):
+    return None if latency != latency else round(latency, 3)  # NaN before connecting
+
+def health():
+    """Summary served on /health"""
+    summary = {
+        'status': 'ok' if bot.is_ready() else 'starting',
+        'guilds': len(bot.guilds),
+        'voice_clients': len(bot.voice_clients),
+        'players': len(players),
+        'latency': round_latency(bot.latency),
+        'startup': startup_phases,
+        'quality': governor.tier.name,
+    }
+    if SHARD_COUNT:
+        summary['shard_count'] = SHARD_COUNT
+        summary['shards'] = {str(shard_id): round_latency(latency) for shard_id, latency in bot.latencies}
+    return summary
+
+async def handle_metrics_request(reader, writer):
+    """Serve GET /metrics (Prometheus text) and /health (JSON)"""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode('latin-1').split()
+        path = parts[1] if len(parts) > 1 else '/'
+
+        if path == '/metrics':
+            status, content_type, body = '200 OK', 'text/plain; version=0.0.4', metrics.render()
+        elif path == '/health':
+            status, content_type, body = '200 OK', 'application/json', json.dumps(health())
+        else:
+            status, content_type, body = '404 Not Found', 'text/plain', 'Not found\n'
+
+        payload = body.encode()
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
 @bot.event
-async def on_ready():
-    print(f'{bot.user} has connected to Discord!')
-    print(f'Bot is in {len(bot.guilds)} guilds')
-    print('Optimized for Raspberry Pi Zero 2W - Using 96kbps audio')
-    
+async def setup_hook():
+    phase_start = startup_phase('login', login_started)
+    ffmpeg_supervisor.reap_leftovers()
+    await restore_state()
+    await loudness.load()
+    startup_phase('restore_state', phase_start)
+    # Buttons of now-playing messages sent before the restart keep working
+    bot.add_view(MusicControlView())
+
+    bot.loop.create_task(state_store.run())
+    bot.loop.create_task(evict_idle_players())
+    bot.loop.create_task(ffmpeg_supervisor.run())
+    if audio_cache.directory:
+        bot.loop.create_task(audio_cache.run())
+    if QUALITY_GOVERNOR:
+        bot.loop.create_task(governor.run())
+    # Both run while the gateway connects
+    bot.loop.create_task(sync_commands())
+    bot.loop.create_task(warm_up_extractor())
+    if METRICS_PORT:
+        await asyncio.start_server(handle_metrics_request, METRICS_HOST, METRICS_PORT)
+        print(f"Metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+    global gateway_started
+    gateway_started = time.perf_counter()
+
+def command_tree_hash():
+    """Hash of the global command definitions as they would be sent to Discord"""
+    payload = [command.to_dict(bot.tree) for command in bot.tree.get_commands()]
+    text = json.dumps({'application_id': bot.application_id, 'commands': payload}, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+async def sync_commands():
+    """Sync the command tree, skipped when it hasn't changed since the last sync"""
+    # Commands are global, one sharded worker syncing them is enough
+    if SYNC_COMMANDS == 'never' or (SHARD_IDS is not None and 0 not in SHARD_IDS):
+        return
+    started = time.perf_counter()
     try:
+        tree_hash = command_tree_hash()
+        if SYNC_COMMANDS != 'always' and await state_store.get_meta('command_tree_hash') == tree_hash:
+            print("Commands unchanged, skipping sync")
+            return
         synced = await bot.tree.sync()
+        await state_store.set_meta('command_tree_hash', tree_hash)
         print(f"Synced {len(synced)} command(s)")
     except Exception as e:
         print(f"Failed to sync commands: {e}")
+    finally:
+        startup_phase('command_sync', started)
+
+async def warm_up_extractor():
+    started = time.perf_counter()
+    try:
+        await extractor.run(warm_up_ytdl, priority=PRIORITY_BACKGROUND, timeout=120)
+    except Exception as e:
+        print(f"yt-dlp warm-up failed: {e}")
+    startup_phase('ytdl_warmup', started)
+
+# Set again right before bot.run() under __main__; a bot started some other
+# way (bench.py, an embedding script) counts login from the import
+login_started = startup_started
+gateway_started = None
+resumed = False
+
+@bot.event
+async def on_ready():
+    global resumed
+    print(f'{bot.user} has connected to Discord!')
+    print(f'Bot is in {len(bot.guilds)} guilds')
+    tier = governor.tier
+    print(f'Audio: {AUDIO_MODE} mode, quality tier {tier.name} ({tier.bitrate} kbps when encoding)')
+    
+    # on_ready also fires after reconnects, only resume once per process
+    if not resumed:
+        resumed = True
+        phase_start = startup_phase('gateway', gateway_started)
+        await resume_playback()
+        ready = startup_phase('resume', phase_start)
+        startup_phases['total'] = round(ready - startup_started, 3)
+        print("Startup: " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in startup_phases.items()))
+        log_event('startup', **startup_phases)
+
+@bot.event
+async def on_voice_state_update(member, before, after):
+    voice_client = member.guild.voice_client
+    guild_player = players.get(member.guild.id)
+    
+    if member.id == bot.user.id and after.channel is None:
+        # Disconnected, by /leave or by someone else
+        if guild_player is not None:
+            cancel_prefetch(member.guild.id)
+            playback_stopped(member.guild.id)
+            if guild_player.empty_timer is not None:
+                guild_player.empty_timer.cancel()
+                guild_player.empty_timer = None
+        return
+    
+    # Drop pending extractions of someone who left the bot's voice channel
+    if voice_client and before.channel == voice_client.channel and after.channel != before.channel:
+        extractor.cancel_guild(member.guild.id, requester_id=member.id)
+    
+    if voice_client and guild_player is not None:
+        check_empty_channel(guild_player, voice_client)
 
 @bot.tree.command(name="play", description="Play a song from YouTube")
 async def play(interaction: discord.Interaction, url: str):
@@ -277,35 +3483,19 @@ async def play(interaction: discord.Interaction, url: str):
         await interaction.response.send_message("You need to be in a voice channel to use this command!", ephemeral=True)
         return
     
+    requested_at = time.perf_counter()
     channel = interaction.user.voice.channel
     await interaction.response.defer(ephemeral=True)
+    url = cached_search_url(url) or url
     
     try:
         # Handle YouTube playlists
         if is_youtube_playlist(url):
-            await interaction.followup.send("📝 Detected playlist! Extracting songs...", ephemeral=True)
-            playlist_urls, playlist_name = await extract_playlist_urls(url)
-            
-            if not playlist_urls:
-                await interaction.followup.send("❌ Could not extract playlist!", ephemeral=True)
+            if get_player(interaction.guild.id).playlist_import is not None:
+                await interaction.followup.send("A playlist is already being imported! Use /cancel-import first.", ephemeral=True)
                 return
             
-            queue = get_queue(interaction.guild.id)
-            
-            for playlist_url in playlist_urls:
-                queue.append(playlist_url)
-            
-            # Show warning if playlist was limited
-            if len(playlist_urls) >= 50:
-                await interaction.followup.send(
-                    f"✅ Added **{len(playlist_urls)}** songs (max 50 for Pi performance)\nPlaylist: **{playlist_name}**", 
-                    ephemeral=True
-                )
-            else:
-                await interaction.followup.send(
-                    f"✅ Added **{len(playlist_urls)}** songs from playlist: **{playlist_name}**", 
-                    ephemeral=True
-                )
+            progress = await interaction.followup.send("📝 Detected playlist! Extracting songs...", ephemeral=True, wait=True)
             
             voice_client = interaction.guild.voice_client
             if voice_client is None:
@@ -313,19 +3503,9 @@ async def play(interaction: discord.Interaction, url: str):
             elif voice_client.channel != channel:
                 await voice_client.move_to(channel)
             
-            if not voice_client.is_playing():
-                first_url = queue.pop(0)
-                player = await YTDLSource.from_url(first_url, loop=bot.loop, stream=True)
-                
-                song_history = get_history(interaction.guild.id)
-                song_history.append(first_url)
-                
-                voice_client.play(player, after=lambda e: asyncio.run_coroutine_threadsafe(
-                    play_next(interaction.guild.id, interaction.channel), bot.loop))
-                
-                view = MusicControlView(interaction.guild.id)
-                await interaction.channel.send(f'Now playing: **{player.title}**', view=view)
-            
+            # Entries keep streaming into the queue after this command returns
+            get_player(interaction.guild.id).playlist_import = bot.loop.create_task(import_playlist(
+                interaction.guild.id, interaction.channel, url, interaction.user.id, progress))
             return
         
         # Connect to voice channel
@@ -339,21 +3519,23 @@ async def play(interaction: discord.Interaction, url: str):
         # If already playing, add to queue
         if voice_client.is_playing() or voice_client.is_paused():
             queue = get_queue(interaction.guild.id)
-            queue.append(url)
+            if len(queue) >= MAX_QUEUE_LENGTH:
+                await interaction.followup.send(f"Queue is full! (max {MAX_QUEUE_LENGTH} songs)", ephemeral=True)
+                return
+            queue.append(Track(url, requester_id=interaction.user.id))
+            save_state(interaction.guild.id)
+            schedule_prefetch(interaction.guild.id)
             await interaction.followup.send(f"Added to queue! Position: {len(queue)}", ephemeral=True)
             return
         
         # Play the audio
-        player = await YTDLSource.from_url(url, loop=bot.loop, stream=True)
+        track = Track(url, requester_id=interaction.user.id)
+        player = await load_track(interaction.guild.id, track, interaction.user.id)
         
         song_history = get_history(interaction.guild.id)
-        song_history.append(url)
+        song_history.append(track)
         
-        voice_client.play(player, after=lambda e: asyncio.run_coroutine_threadsafe(
-            play_next(interaction.guild.id, interaction.channel), bot.loop))
-        
-        view = MusicControlView(interaction.guild.id)
-        await interaction.channel.send(f'Now playing: **{player.title}**', view=view)
+        start_playback(interaction.guild.id, track, player, voice_client, interaction.channel, requested_at)
         await interaction.followup.send(f'Started playing: **{player.title}**', ephemeral=True)
     
     except Exception as e:
@@ -368,8 +3550,10 @@ async def play_now(interaction: discord.Interaction, url: str):
         await interaction.response.send_message("You need to be in a voice channel to use this command!", ephemeral=True)
         return
     
+    requested_at = time.perf_counter()
     channel = interaction.user.voice.channel
     await interaction.response.defer(ephemeral=True)
+    url = cached_search_url(url) or url
     
     try:
         if interaction.guild.voice_client is None:
@@ -379,19 +3563,19 @@ async def play_now(interaction: discord.Interaction, url: str):
             if voice_client.channel != channel:
                 await voice_client.move_to(channel)
         
+        track = Track(url, requester_id=interaction.user.id)
+        player = await load_track(interaction.guild.id, track, interaction.user.id)
+        
+        # Swap tracks without awaiting in between, so the stopped track's
+        # after= callback sees audio playing and leaves the queue alone
         if voice_client.is_playing() or voice_client.is_paused():
             voice_client.stop()
         
-        player = await YTDLSource.from_url(url, loop=bot.loop, stream=True)
-        
         song_history = get_history(interaction.guild.id)
-        song_history.append(url)
-        
-        voice_client.play(player, after=lambda e: asyncio.run_coroutine_threadsafe(
-            play_next(interaction.guild.id, interaction.channel), bot.loop))
+        song_history.append(track)
         
-        view = MusicControlView(interaction.guild.id)
-        await interaction.channel.send(f'Playing now: **{player.title}**', view=view)
+        start_playback(interaction.guild.id, track, player, voice_client, interaction.channel, requested_at)
+        schedule_prefetch(interaction.guild.id)
         await interaction.followup.send(f'Started playing immediately: **{player.title}**', ephemeral=True)
     
     except Exception as e:
@@ -401,20 +3585,21 @@ async def play_now(interaction: discord.Interaction, url: str):
 async def play_next(guild_id, channel):
     """Play the next song in the queue"""
     voice_client = discord.utils.get(bot.voice_clients, guild__id=guild_id)
-    if not voice_client:
+    if not voice_client or get_player(guild_id).leaving:
+        return
+    
+    # /play-now already started another track
+    if voice_client.is_playing() or voice_client.is_paused():
         return
     
     # Check if loop is enabled
     if get_loop_state(guild_id):
         song_history = get_history(guild_id)
         if song_history:
-            url = song_history[-1]
+            track = song_history[-1]
             try:
-                player = await YTDLSource.from_url(url, loop=bot.loop, stream=True)
-                voice_client.play(player, after=lambda e: asyncio.run_coroutine_threadsafe(
-                    play_next(guild_id, channel), bot.loop))
-                view = MusicControlView(guild_id)
-                await channel.send(f'🔁 Looping: **{player.title}**', view=view)
+                player = await load_track(guild_id, track)
+                start_playback(guild_id, track, player, voice_client, channel)
                 return
             except Exception as e:
                 await channel.send(f"Error looping song: {str(e)}")
@@ -423,19 +3608,24 @@ async def play_next(guild_id, channel):
     queue = get_queue(guild_id)
     
     if len(queue) > 0:
-        url = queue.pop(0)
+        track = queue.popleft()
+        save_state(guild_id)
         try:
             song_history = get_history(guild_id)
-            song_history.append(url)
+            song_history.append(track)
             
-            player = await YTDLSource.from_url(url, loop=bot.loop, stream=True)
-            voice_client.play(player, after=lambda e: asyncio.run_coroutine_threadsafe(
-                play_next(guild_id, channel), bot.loop))
-            view = MusicControlView(guild_id)
-            await channel.send(f'Now playing: **{player.title}**', view=view)
+            player = take_prewarmed(guild_id, track) or await load_track(guild_id, track)
+            start_playback(guild_id, track, player, voice_client, channel)
+            schedule_prefetch(guild_id)
         except Exception as e:
+            playback_stopped(guild_id)
             await channel.send(f"Error playing next song: {str(e)}")
             print(f"Error in play_next: {e}")
+    else:
+        playback_stopped(guild_id)
+
+play.autocomplete('url')(url_autocomplete)
+play_now.autocomplete('url')(url_autocomplete)
 
 @bot.tree.command(name="pause", description="Pause the current song")
 async def pause(interaction: discord.Interaction):
@@ -444,6 +3634,7 @@ async def pause(interaction: discord.Interaction):
     
     if voice_client and voice_client.is_playing():
         voice_client.pause()
+        update_now_playing(interaction.guild.id)
         await interaction.response.send_message("⏸️ Paused", ephemeral=True)
     else:
         await interaction.response.send_message("Nothing is playing right now!", ephemeral=True)
@@ -455,6 +3646,7 @@ async def resume(interaction: discord.Interaction):
     
     if voice_client and voice_client.is_paused():
         voice_client.resume()
+        update_now_playing(interaction.guild.id)
         await interaction.response.send_message("▶️ Resumed", ephemeral=True)
     else:
         await interaction.response.send_message("Nothing is paused right now!", ephemeral=True)
@@ -470,15 +3662,58 @@ async def skip(interaction: discord.Interaction):
     else:
         await interaction.response.send_message("Nothing is playing right now!", ephemeral=True)
 
+def parse_position(text):
+    """Seconds from '90', '1:30' or '1:02:03', None if it isn't a position"""
+    try:
+        parts = [float(part) for part in text.strip().split(':')]
+    except ValueError:
+        return None
+    if len(parts) > 3 or any(part < 0 for part in parts):
+        return None
+    seconds = 0
+    for part in parts:
+        seconds = seconds * 60 + part
+    return seconds
+
+@bot.tree.command(name="seek", description="Jump to a position in the current song")
+async def seek(interaction: discord.Interaction, position: str):
+    """Restart the current song at a position like 1:30"""
+    guild_player = get_player(interaction.guild.id)
+    track = guild_player.current
+    voice_client = interaction.guild.voice_client
+    if track is None or playback_position(interaction.guild.id) is None:
+        await interaction.response.send_message("Nothing is playing right now!", ephemeral=True)
+        return
+
+    seconds = parse_position(position)
+    if seconds is None:
+        await interaction.response.send_message("Use a position like `90`, `1:30` or `1:02:03`!", ephemeral=True)
+        return
+    if track.duration and seconds >= track.duration:
+        await interaction.response.send_message(
+            f"The song is only {format_duration(track.duration)} long!", ephemeral=True)
+        return
+
+    await interaction.response.defer(ephemeral=True)
+    try:
+        source = await load_track_at(interaction.guild.id, track, seconds)
+        if guild_player.current is not track:
+            source.cleanup()  # The song changed while the stream was loading
+            await interaction.followup.send("The song changed, seek again!", ephemeral=True)
+            return
+        restart_at(interaction.guild.id, track, source, voice_client, interaction.channel, seconds)
+        await interaction.followup.send(f"⏩ Jumped to {format_duration(seconds) if seconds else '0:00'}", ephemeral=True)
+    except Exception as e:
+        await interaction.followup.send(f"An error occurred: {str(e)}", ephemeral=True)
+        print(f"Error in seek command: {e}")
+
 @bot.tree.command(name="stop", description="Stop playing and clear the queue")
 async def stop(interaction: discord.Interaction):
     """Stop playing and clear the queue"""
     voice_client = interaction.guild.voice_client
     
     if voice_client:
-        queue = get_queue(interaction.guild.id)
-        queue.clear()
-        set_loop_state(interaction.guild.id, False)
+        get_player(interaction.guild.id).reset()
         voice_client.stop()
         await interaction.response.send_message("⏹️ Stopped and cleared queue", ephemeral=True)
     else:
@@ -490,14 +3725,22 @@ async def leave(interaction: discord.Interaction):
     voice_client = interaction.guild.voice_client
     
     if voice_client:
-        await voice_client.disconnect()
-        queue = get_queue(interaction.guild.id)
-        queue.clear()
-        set_loop_state(interaction.guild.id, False)
+        guild_player = get_player(interaction.guild.id)
+        guild_player.reset()
+        await disconnect_player(guild_player)
+        remove_player(interaction.guild.id)
         await interaction.response.send_message("👋 Disconnected", ephemeral=True)
     else:
         await interaction.response.send_message("I'm not in a voice channel!", ephemeral=True)
 
+@bot.tree.command(name="cancel-import", description="Stop importing the playlist that is being added")
+async def cancel_import(interaction: discord.Interaction):
+    """Cancel a running playlist import, songs already added stay queued"""
+    if cancel_playlist_import(interaction.guild.id):
+        await interaction.response.send_message("⏹️ Playlist import cancelled", ephemeral=True)
+    else:
+        await interaction.response.send_message("No playlist is being imported!", ephemeral=True)
+
 @bot.tree.command(name="queue", description="Show the current queue")
 async def show_queue(interaction: discord.Interaction):
     """Show the current queue"""
@@ -506,9 +3749,12 @@ async def show_queue(interaction: discord.Interaction):
     if len(queue) == 0:
         await interaction.response.send_message("The queue is empty!", ephemeral=True)
     else:
-        queue_list = "\n".join([f"{i+1}. {url}" for i, url in enumerate(queue[:20])])  # Show first 20
+        queue_list = "\n".join([f"{i+1}. {track.display_title} ({format_duration(track.duration)})"
+                                for i, track in enumerate(islice(queue, 20))])  # Show first 20
         if len(queue) > 20:
             queue_list += f"\n... and {len(queue) - 20} more"
+        total = sum(track.duration or 0 for track in queue)
+        queue_list += f"\n\n{len(queue)} songs, {format_duration(total)} total"
         await interaction.response.send_message(f"**Current Queue:**\n{queue_list}", ephemeral=True)
 
 @bot.tree.command(name="volume", description="Set playback volume (0-100)")
@@ -518,20 +3764,197 @@ async def volume(interaction: discord.Interaction, level: int):
         await interaction.response.send_message("Volume must be between 0 and 100!", ephemeral=True)
         return
     
+    set_volume(interaction.guild.id, level / 100)
     voice_client = interaction.guild.voice_client
     
-    if voice_client and voice_client.source:
-        voice_client.source.volume = level / 100
+    source = getattr(voice_client.source, 'inner', None) if voice_client else None
+    position = playback_position(interaction.guild.id)
+    if isinstance(source, BroadcastListener):
+        await interaction.response.send_message(
+            f"🔊 Volume set to {level}% for this server's own songs; the station plays at its own volume", ephemeral=True)
+    elif isinstance(source, discord.PCMVolumeTransformer):
+        source.volume = level / 100 * getattr(source, 'gain', 1.0)
         await interaction.response.send_message(f"🔊 Volume set to {level}%", ephemeral=True)
+    elif position is not None:
+        # Opus sources have the volume baked into the FFmpeg pipeline, restart it where it is
+        await interaction.response.defer(ephemeral=True)
+        track = get_player(interaction.guild.id).current
+        try:
+            source = await load_track_at(interaction.guild.id, track, position)
+        except Exception as e:
+            await interaction.followup.send(f"🔊 Volume set to {level}% (applies from the next song)", ephemeral=True)
+            print(f"Error restarting at new volume: {e}")
+            return
+        if get_player(interaction.guild.id).current is not track:
+            source.cleanup()
+        else:
+            restart_at(interaction.guild.id, track, source, voice_client, interaction.channel, position)
+        await interaction.followup.send(f"🔊 Volume set to {level}%", ephemeral=True)
+    elif voice_client and voice_client.source:
+        await interaction.response.send_message(f"🔊 Volume set to {level}% (applies from the next song)", ephemeral=True)
     else:
-        await interaction.response.send_message("Nothing is playing right now!", ephemeral=True)
+        await interaction.response.send_message(f"🔊 Volume set to {level}%", ephemeral=True)
+
+@bot.tree.command(name="quality", description="Set audio quality for this server, or let the bot adapt it to load")
+@app_commands.choices(level=[app_commands.Choice(name="Auto", value="auto")] +
+                      [app_commands.Choice(name=tier.name.capitalize(), value=tier.name) for tier in QUALITY_TIERS])
+async def quality(interaction: discord.Interaction, level: str):
+    """Pin the quality tier of a guild or hand it back to the governor"""
+    guild_player = get_player(interaction.guild.id)
+    guild_player.quality = None if level == 'auto' else level
+    save_state(interaction.guild.id)
+
+    tier = governor.tier_for(interaction.guild.id)
+    if level == 'auto':
+        message = f"🎚️ Quality: automatic (currently **{tier.name}**, {tier.bitrate} kbps)"
+    else:
+        message = f"🎚️ Quality set to **{tier.name}** ({tier.bitrate} kbps)"
+    await interaction.response.send_message(message + " - applies from the next song", ephemeral=True)
+
+@bot.tree.command(name="cache-stats", description="Show cache statistics")
+async def cache_stats(interaction: discord.Interaction):
+    """Show extraction and audio cache statistics"""
+    stats = extraction_cache.stats()
+    message = (
+        f"**Extraction cache:** {stats['entries']} entries\n"
+        f"Hits: {stats['hits']} | Misses: {stats['misses']} | Refreshes: {stats['refreshes']}\n"
+        f"Hit rate: {stats['hit_rate']:.0%} | Shared in-flight: {extractor.coalesced}"
+    )
+    if LOUDNESS_NORMALIZATION:
+        message += f"\n**Loudness:** {len(loudness.levels)} songs measured, {len(loudness.pending)} waiting"
+    if audio_cache.directory:
+        audio = audio_cache.stats()
+        message += (f"\n**Audio cache:** {audio['files']} songs, "
+                    f"{audio['bytes'] / 1048576:.1f} / {audio['max_bytes'] / 1048576:.0f} MB")
+    await interaction.response.send_message(message, ephemeral=True)
+
+broadcast_group = app_commands.Group(name="broadcast", description="Play one stream in several servers at once")
+
+@broadcast_group.command(name="start", description="Start a broadcast station, or queue a song on yours")
+async def broadcast_start(interaction: discord.Interaction, name: str, url: str):
+    """Start a station and listen to it here; on an existing station of this server, queue the song"""
+    if not interaction.user.voice:
+        await interaction.response.send_message("You need to be in a voice channel to use this command!", ephemeral=True)
+        return
+
+    requested_at = time.perf_counter()
+    channel = interaction.user.voice.channel
+    await interaction.response.defer(ephemeral=True)
+    url = cached_search_url(url) or url
+    track = Track(url, requester_id=interaction.user.id)
+
+    station = broadcasts.get(name)
+    if station is not None:
+        if station.owner_id != interaction.guild.id:
+            await interaction.followup.send(f"❌ Station **{name}** belongs to another server!", ephemeral=True)
+        else:
+            station.queue.append(track)
+            await interaction.followup.send(f"📻 Queued on **{name}**: {track.display_title}", ephemeral=True)
+        return
+
+    try:
+        data = await YTDLSource.resolve(url, guild_id=interaction.guild.id, requester_id=interaction.user.id)
+        track.update(data)
+        if broadcasts.get(name) is not None:
+            await interaction.followup.send(f"❌ Station **{name}** was just started, try again!", ephemeral=True)
+            return
+        station = broadcasts[name] = BroadcastStation(name, interaction.guild.id)
+        station.start(create_broadcast_source(data, interaction.guild.id), track)
+
+        if interaction.guild.voice_client is None:
+            voice_client = await channel.connect()
+        else:
+            voice_client = interaction.guild.voice_client
+            if voice_client.channel != channel:
+                await voice_client.move_to(channel)
+
+        listen_to_broadcast(interaction.guild.id, station, voice_client, interaction.channel, requested_at)
+        await interaction.channel.send(f'📻 Broadcasting **{name}**: **{track.display_title}** - '
+                                       f'other servers can tune in with `/broadcast join {name}`')
+        await interaction.followup.send(f"Started station **{name}**", ephemeral=True)
+
+    except Exception as e:
+        if station is not None and not station.listeners:
+            station.stop()
+        await interaction.followup.send(f"An error occurred: {str(e)}", ephemeral=True)
+        print(f"Error in broadcast start command: {e}")
+
+@broadcast_group.command(name="join", description="Listen to a broadcast station in this server")
+async def broadcast_join(interaction: discord.Interaction, name: str):
+    """Tune this server in at the station's live position"""
+    if not interaction.user.voice:
+        await interaction.response.send_message("You need to be in a voice channel to use this command!", ephemeral=True)
+        return
+
+    station = broadcasts.get(name)
+    if station is None or station.ended:
+        await interaction.response.send_message(f"❌ No station named **{name}** is on air!", ephemeral=True)
+        return
+
+    requested_at = time.perf_counter()
+    channel = interaction.user.voice.channel
+    await interaction.response.defer(ephemeral=True)
+    try:
+        if interaction.guild.voice_client is None:
+            voice_client = await channel.connect()
+        else:
+            voice_client = interaction.guild.voice_client
+            if voice_client.channel != channel:
+                await voice_client.move_to(channel)
+
+        listener = listen_to_broadcast(interaction.guild.id, station, voice_client, interaction.channel, requested_at)
+        await interaction.channel.send(f'Tuned in: **{listener.title}**')
+        await interaction.followup.send(f"Listening to **{name}** with {len(station.listeners) - 1} other server(s). "
+                                        f"`/skip` goes back to this server's queue", ephemeral=True)
+
+    except Exception as e:
+        await interaction.followup.send(f"An error occurred: {str(e)}", ephemeral=True)
+        print(f"Error in broadcast join command: {e}")
+
+@broadcast_join.autocomplete('name')
+async def broadcast_name_autocomplete(interaction: discord.Interaction, current: str):
+    current = current.lower()
+    return [app_commands.Choice(name=f"{name} ({len(station.listeners)} listening)", value=name)
+            for name, station in list(broadcasts.items()) if current in name.lower()][:25]
+
+@broadcast_group.command(name="stop", description="Stop this server's broadcast station")
+async def broadcast_stop(interaction: discord.Interaction, name: str):
+    """End a station for every listener; their own queues continue"""
+    station = broadcasts.get(name)
+    if station is None or station.owner_id != interaction.guild.id:
+        await interaction.response.send_message(f"❌ This server has no station named **{name}**!", ephemeral=True)
+        return
+    station.stop()
+    await interaction.response.send_message(f"⏹️ Stopped station **{name}** ({len(station.listeners)} server(s) were listening)")
+
+bot.tree.add_command(broadcast_group)
 
 # Run the bot
 if __name__ == "__main__":
-    load_dotenv()
+    startup_phase('import', startup_started)
     TOKEN = os.getenv("DISCORD_BOT_TOKEN", "NONE")
-    if not TOKEN:
+    if not check_ffmpeg():
+        report_missing_ffmpeg()
+        exit(1)
+    elif not TOKEN:
         print("ERROR: Please set DISCORD_BOT_TOKEN environment variable")
         print("You can get a token from https://discord.com/developers/applications")
     else:
-        bot.run(TOKEN)
\ No newline at end of file
+        event_handler = logging.StreamHandler()
+        event_handler.setFormatter(logging.Formatter('%(message)s'))
+        event_log.addHandler(event_handler)
+        event_log.setLevel(logging.INFO)
+        event_log.propagate = False  # Keep events out of discord.py's log handler
+
+        def stop_on_sigterm(signum, frame):
+            # Shut down like Ctrl+C so the state store gets flushed (launcher.py stops workers this way)
+            raise KeyboardInterrupt
+
+        signal.signal(signal.SIGTERM, stop_on_sigterm)
+        login_started = time.perf_counter()
+        try:
+            bot.run(TOKEN)
+        finally:
+            state_store.close()
+            ffmpeg_supervisor.close()
+            audio_cache.close()
\ No newline at end of file
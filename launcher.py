@@ -0,0 +1,276 @@
+"""Run the bot as several sharded worker processes.
+
+Each worker is a separate `bot.py` process that connects a contiguous range
+of shards and owns the guilds on them, so audio work spreads over CPU cores
+instead of sharing one interpreter. Workers that exit are restarted with
+backoff, and with METRICS_PORT set the launcher serves combined /health and
+/metrics for all of them.
+
+    python launcher.py                      # one worker and shard per core
+    SHARD_COUNT=8 WORKERS=4 python launcher.py
+"""
+
+import asyncio
+import json
+import os
+import shutil
+import signal
+import sys
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+WORKERS = int(os.getenv("WORKERS", str(os.cpu_count() or 1)))  # Worker processes
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) or WORKERS  # Discord needs a shard per 2500 guilds
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # Launcher port, worker i uses METRICS_PORT + 1 + i
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", "")
+
+IDENTIFY_DELAY = 5.0  # Discord allows one shard to identify every 5 seconds
+RESTART_BACKOFF_MAX = 60.0  # Longest wait before restarting a crashed worker
+STABLE_SECONDS = 120.0  # A worker up this long starts over with the shortest backoff
+STOP_TIMEOUT = 15.0  # Seconds a worker gets to save state before it is killed
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+
+class Worker:
+    """One bot.py process and the shards it runs"""
+
+    def __init__(self, index, shard_ids):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.port = METRICS_PORT + 1 + index if METRICS_PORT else 0
+        self.process = None
+        self.started_at = None
+        self.restarts = 0
+        self.backoff = 1.0
+        self.stopping = False
+        self.restart_requested = asyncio.Event()
+
+    def env(self):
+        env = dict(os.environ)
+        env.update({
+            'SHARD_COUNT': str(SHARD_COUNT),
+            'SHARD_IDS': ','.join(map(str, self.shard_ids)),
+            'METRICS_PORT': str(self.port),
+            'PYTHONUNBUFFERED': '1',
+        })
+        if AUDIO_CACHE_DIR:
+            # The audio cache index belongs to one process
+            env['AUDIO_CACHE_DIR'] = os.path.join(AUDIO_CACHE_DIR, f"worker-{self.index}")
+        return env
+
+    @property
+    def name(self):
+        return f"worker {self.index} (shards {self.shard_ids[0]}-{self.shard_ids[-1]})"
+
+    async def supervise(self, delay):
+        """Start the process after delay and keep it running until stop()"""
+        await asyncio.sleep(delay)
+        while not self.stopping:
+            self.process = await asyncio.create_subprocess_exec(
+                sys.executable, BOT_SCRIPT, env=self.env(),
+                stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT)
+            self.started_at = time.monotonic()
+            print(f"Started {self.name}, pid {self.process.pid}")
+            await self.relay_output()
+            code = await self.process.wait()
+            if self.stopping:
+                return
+
+            if self.restart_requested.is_set():
+                self.restart_requested.clear()
+                delay = 0
+            else:
+                if time.monotonic() - self.started_at >= STABLE_SECONDS:
+                    self.backoff = 1.0
+                delay = self.backoff
+                self.backoff = min(self.backoff * 2, RESTART_BACKOFF_MAX)
+            self.restarts += 1
+            print(f"{self.name} exited with code {code}, restarting in {delay:g}s")
+            await asyncio.sleep(delay)
+
+    async def relay_output(self):
+        prefix = f"[worker {self.index}]"
+        async for line in self.process.stdout:
+            print(prefix, line.decode(errors='replace').rstrip())
+
+    def running(self):
+        return self.process is not None and self.process.returncode is None
+
+    def restart(self):
+        """Stop the process, supervise() starts it again right away"""
+        if self.running():
+            self.restart_requested.set()
+            self.process.terminate()
+
+    async def stop(self):
+        self.stopping = True
+        if not self.running():
+            return
+        self.process.terminate()
+        try:
+            await asyncio.wait_for(self.process.wait(), STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"{self.name} did not stop, killing it")
+            self.process.kill()
+            await self.process.wait()
+
+    def status(self):
+        return {
+            'worker': self.index,
+            'shards': self.shard_ids,
+            'pid': self.process.pid if self.running() else None,
+            'running': self.running(),
+            'restarts': self.restarts,
+            'uptime': round(time.monotonic() - self.started_at) if self.running() else None,
+        }
+
+def split_shards(shard_count, workers):
+    """Contiguous shard ranges, as even as possible"""
+    workers = max(1, min(workers, shard_count))
+    return [list(range(i * shard_count // workers, (i + 1) * shard_count // workers)) for i in range(workers)]
+
+# Combined health and metrics
+
+async def http_get(port, path, timeout=2.0):
+    """Body of a GET to a worker's metrics server, or None when it doesn't answer"""
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return None
+    try:
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n".encode())
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return None
+    finally:
+        writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    if not head.startswith(b'HTTP/1.1 200'):
+        return None
+    return body.decode()
+
+async def combined_health(workers):
+    async def worker_health(worker):
+        status = worker.status()
+        body = await http_get(worker.port, '/health') if worker.running() and worker.port else None
+        status['health'] = json.loads(body) if body else None
+        return status
+
+    statuses = await asyncio.gather(*(worker_health(worker) for worker in workers))
+    healthy = all(s['health'] and s['health']['status'] == 'ok' for s in statuses)
+    return {
+        'status': 'ok' if healthy else 'degraded',
+        'shard_count': SHARD_COUNT,
+        'guilds': sum(s['health']['guilds'] for s in statuses if s['health']),
+        'voice_clients': sum(s['health']['voice_clients'] for s in statuses if s['health']),
+        'workers': statuses,
+    }
+
+def add_label(sample, label):
+    """Insert a label into one Prometheus sample line"""
+    name, value = sample.rsplit(' ', 1)
+    if name.endswith('}'):
+        return f"{name[:-1]},{label}}} {value}"
+    return f"{name}{{{label}}} {value}"
+
+async def combined_metrics(workers):
+    """All workers' metrics with a worker label, grouped per metric family"""
+    bodies = await asyncio.gather(*(http_get(worker.port, '/metrics') if worker.running() else asyncio.sleep(0)
+                                    for worker in workers))
+    families = {}  # name -> [help/type lines, samples]
+    for worker, body in zip(workers, bodies):
+        family = None
+        for line in (body or '').splitlines():
+            if not line:
+                continue
+            if line.startswith('# '):
+                family = line.split()[2]
+                headers, samples = families.setdefault(family, [[], []])
+                if line not in headers:
+                    headers.append(line)
+                continue
+            name = line.split('{', 1)[0].split(' ', 1)[0]
+            if family is None or not name.startswith(family):
+                family = name
+            families.setdefault(family, [[], []])[1].append(add_label(line, f'worker="{worker.index}"'))
+
+    lines = ['# HELP musicbot_worker_up Whether the worker process is running', '# TYPE musicbot_worker_up gauge']
+    lines += [f'musicbot_worker_up{{worker="{w.index}"}} {int(w.running())}' for w in workers]
+    lines += ['# HELP musicbot_worker_restarts_total Times the worker process was restarted',
+              '# TYPE musicbot_worker_restarts_total counter']
+    lines += [f'musicbot_worker_restarts_total{{worker="{w.index}"}} {w.restarts}' for w in workers]
+    for headers, samples in families.values():
+        lines.extend(headers)
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+async def handle_request(workers, reader, writer):
+    """GET /health, GET /metrics, POST /workers/<n>/restart"""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode('latin-1').split()
+        method, path = (parts[0], parts[1]) if len(parts) > 1 else ('GET', '/')
+
+        status, content_type, body = '404 Not Found', 'text/plain', 'Not found\n'
+        if method == 'GET' and path == '/health':
+            status, content_type, body = '200 OK', 'application/json', json.dumps(await combined_health(workers))
+        elif method == 'GET' and path == '/metrics':
+            status, content_type, body = '200 OK', 'text/plain; version=0.0.4', await combined_metrics(workers)
+        elif method == 'POST' and path.startswith('/workers/') and path.endswith('/restart'):
+            index = path.split('/')[2]
+            worker = workers[int(index)] if index.isdigit() and int(index) < len(workers) else None
+            if worker is not None:
+                worker.restart()
+                status, content_type, body = '202 Accepted', 'application/json', json.dumps(worker.status())
+
+        payload = body.encode()
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def main():
+    workers = [Worker(i, shard_ids) for i, shard_ids in enumerate(split_shards(SHARD_COUNT, WORKERS))]
+    print(f"Running {SHARD_COUNT} shard(s) in {len(workers)} worker process(es)")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass  # Windows, Ctrl+C raises KeyboardInterrupt instead
+
+    if METRICS_PORT:
+        await asyncio.start_server(lambda r, w: handle_request(workers, r, w), METRICS_HOST, METRICS_PORT)
+        print(f"Health on http://{METRICS_HOST}:{METRICS_PORT}/health")
+
+    # Stagger the starts so shards identify one at a time
+    tasks = [asyncio.create_task(worker.supervise(worker.shard_ids[0] * IDENTIFY_DELAY)) for worker in workers]
+    await stop.wait()
+    print("Stopping workers...")
+    await asyncio.gather(*(worker.stop() for worker in workers))
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+if __name__ == "__main__":
+    if not os.getenv("DISCORD_BOT_TOKEN"):
+        sys.exit("ERROR: Please set DISCORD_BOT_TOKEN environment variable")
+    if not shutil.which("ffmpeg") and not os.path.exists("ffmpeg.exe"):
+        sys.exit("ERROR: FFmpeg not found! See FFMPEG_INSTALL.md")
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
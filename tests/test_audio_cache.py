@@ -0,0 +1,74 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import discord
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot
+
+
+def opus_available():
+    return discord.opus.is_loaded() or discord.opus._load_default()
+
+
+pytestmark = [
+    pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="needs ffmpeg"),
+    pytest.mark.skipif(not opus_available(), reason="needs libopus"),
+]
+
+
+@pytest.fixture
+def song(tmp_path):
+    path = tmp_path / 'song.ogg'
+    subprocess.run(['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', 'sine=frequency=440:duration=2',
+                    '-c:a', 'libopus', '-b:a', '64k', str(path)], check=True)
+    return str(path)
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = bot.AudioCache(str(tmp_path / 'cache'), 10 * 1024 * 1024)
+    monkeypatch.setattr(bot, 'audio_cache', cache)
+    yield cache
+    cache.close()
+
+
+def record(cache, song):
+    track = bot.Track('https://www.youtube.com/watch?v=aaaaaaaaaaa', id='aaaaaaaaaaa', title='Sine', duration=2)
+    writer = cache.record({'id': track.id, 'title': track.title, 'duration': track.duration})
+    source = discord.FFmpegOpusAudio(song, codec='copy')
+    while True:
+        packet = source.read()
+        if not packet:
+            break
+        writer.write(packet)
+    source.cleanup()
+    writer.complete = True
+    writer.close()
+    cache._executor.submit(lambda: None).result()
+    return track
+
+
+def test_recording_has_no_stream_headers(cache, song):
+    track = record(cache, song)
+    path = cache.lookup(track.id)[0]
+    source = bot.CachedOpusSource(path, {})
+    first = source.read()
+    source.cleanup()
+    assert first and not bot.is_opus_header(first)
+
+
+def test_replay_at_reduced_volume_decodes(cache, song, monkeypatch):
+    track = record(cache, song)
+    monkeypatch.setattr(bot, 'get_volume', lambda guild_id: 0.5)
+    path = cache.lookup(track.id)[0]
+    source = bot.create_cached_source(path, track)
+    assert not source.is_opus()
+    frames = 0
+    while source.read():
+        frames += 1
+    source.cleanup()
+    assert frames >= 90
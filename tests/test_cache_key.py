@@ -0,0 +1,19 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot
+
+
+def test_youtube_links_use_the_video_id():
+    assert bot.cache_key('https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=10') == 'dQw4w9WgXcQ'
+    assert bot.cache_key('https://youtu.be/dQw4w9WgXcQ') == 'dQw4w9WgXcQ'
+
+
+def test_other_urls_keep_their_case():
+    assert bot.cache_key(' https://soundcloud.com/Artist/Track ') == 'https://soundcloud.com/Artist/Track'
+    assert bot.cache_key('https://example.com/A') != bot.cache_key('https://example.com/a')
+
+
+def test_search_text_is_folded():
+    assert bot.cache_key('  Never Gonna   Give You Up ') == 'search:never gonna give you up'
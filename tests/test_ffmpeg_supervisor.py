@@ -0,0 +1,65 @@
+import os
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+import discord
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot
+
+GUILD_ID = 1234
+
+
+@pytest.fixture
+def processes(monkeypatch):
+    monkeypatch.setattr(bot, 'ffmpeg_processes', {})
+    monkeypatch.setattr(bot, 'FFMPEG_PER_GUILD', 1)
+    started = []
+
+    def spawn():
+        process = subprocess.Popen(['sleep', '30'])
+        bot.ffmpeg_processes[process.pid] = (GUILD_ID, process)
+        started.append(process)
+        return process
+
+    yield spawn
+    for process in started:
+        process.kill()
+        process.wait()
+
+
+class ProcessSource(discord.AudioSource):
+    def __init__(self, process):
+        self._process = process
+
+    def read(self):
+        return b''
+
+
+def play(monkeypatch, process):
+    """Put a source backed by process on the guild's voice client, wrapped like start_playback does"""
+    inner = discord.PCMVolumeTransformer(ProcessSource(process))
+    metered = bot.MeteredSource(inner, GUILD_ID, time.perf_counter(), None)
+    voice_client = SimpleNamespace(guild=SimpleNamespace(id=GUILD_ID), source=metered)
+    monkeypatch.setitem(bot.bot._connection._voice_clients, GUILD_ID, voice_client)
+    return metered
+
+
+def test_process_found_through_metered_source(monkeypatch, processes):
+    process = processes()
+    assert bot.ffmpeg_process_of(play(monkeypatch, process)) is process
+
+
+def test_enforce_spares_playing_process(tmp_path, monkeypatch, processes):
+    stale = processes()
+    playing = processes()
+    new = processes()
+    play(monkeypatch, playing)
+    supervisor = bot.FFmpegSupervisor(str(tmp_path / 'ffmpeg.pids'))
+    supervisor.enforce(GUILD_ID, keep=new.pid)
+    assert playing.poll() is None
+    assert new.poll() is None
+    assert stale.poll() is not None
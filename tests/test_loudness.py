@@ -0,0 +1,49 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import discord
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot
+
+pytestmark = pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="needs ffmpeg")
+
+
+@pytest.fixture
+def song(tmp_path):
+    path = tmp_path / 'song.ogg'
+    subprocess.run(['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', 'sine=frequency=440:duration=5',
+                    '-af', 'volume=-12dB', '-c:a', 'libopus', '-b:a', '64k', str(path)], check=True)
+    return str(path)
+
+
+def measure_file(path):
+    result = subprocess.run(['ffmpeg', '-hide_banner', '-nostats', '-i', path, '-af', 'ebur128',
+                             '-f', 'null', '-'], capture_output=True, check=True)
+    return float(bot.LOUDNESS_RE.search(result.stderr.decode()).group(1))
+
+
+def test_spooled_sample_measures_like_the_file(song):
+    sample = bot.LoudnessSample('aaaaaaaaaaa', 1.0)
+    source = discord.FFmpegOpusAudio(song, codec='copy')
+    while True:
+        packet = source.read()
+        if not packet:
+            break
+        sample.write(packet)
+        assert len(sample._page) < bot.OGG_PACKETS_PER_PAGE
+    source.cleanup()
+    assert sample.packets * bot.FRAME_SECONDS == pytest.approx(5, abs=0.1)
+    lufs = bot.loudness.analyze(sample)
+    sample.discard()
+    assert lufs == pytest.approx(measure_file(song), abs=0.2)
+
+
+def test_sample_without_stream_headers_is_dropped():
+    sample = bot.LoudnessSample('aaaaaaaaaaa', 1.0)
+    sample.write(b'\xfc\xff\xfe')
+    assert sample.packets == 0
+    assert sample.stream() is None
@@ -0,0 +1,124 @@
+import asyncio
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot
+
+GUILD_ID = 1234
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = bot.StateStore(str(tmp_path / 'state.db'))
+    monkeypatch.setattr(bot, 'state_store', store)
+    monkeypatch.setattr(bot, 'players', {})
+    monkeypatch.setattr(bot, 'dormant', bot.OrderedDict())
+    yield store
+    store.close()
+
+
+def fill(guild_id, songs=3):
+    guild_player = bot.get_player(guild_id)
+    guild_player.volume = 0.5
+    guild_player.loop = True
+    for i in range(songs):
+        guild_player.queue.append(bot.Track(f'https://www.youtube.com/watch?v=song{i:07d}', title=f'Song {i}'))
+    bot.save_state(guild_id)
+    return guild_player
+
+
+def test_evicted_guild_reloads_from_database(store):
+    fill(GUILD_ID)
+    asyncio.run(store.flush())
+    bot.remove_player(GUILD_ID)
+    assert GUILD_ID not in bot.dormant
+    guild_player = bot.get_player(GUILD_ID)
+    assert guild_player.volume == 0.5 and guild_player.loop
+    assert [t.title for t in guild_player.queue] == ['Song 0', 'Song 1', 'Song 2']
+
+
+def test_unwritten_changes_survive_eviction(store):
+    fill(GUILD_ID)
+    bot.remove_player(GUILD_ID)
+    assert [t.title for t in bot.get_player(GUILD_ID).queue] == ['Song 0', 'Song 1', 'Song 2']
+
+
+def test_reading_settings_does_not_revive(store):
+    fill(GUILD_ID)
+    bot.remove_player(GUILD_ID)
+    assert bot.get_volume(GUILD_ID) == 0.5
+    assert bot.get_loop_state(GUILD_ID)
+    assert bot.get_volume(GUILD_ID + 1) == bot.DEFAULT_VOLUME
+    assert not bot.players
+
+
+def test_dormant_is_bounded_without_database(store, monkeypatch):
+    store.path = ''
+    monkeypatch.setattr(bot, 'DORMANT_MAX', 2)
+    for guild_id in range(5):
+        fill(guild_id)
+        bot.remove_player(guild_id)
+    assert list(bot.dormant) == [3, 4]
+    assert bot.get_volume(4) == 0.5
+    assert bot.get_volume(0) == bot.DEFAULT_VOLUME
+
+
+def saved_titles(store, guild_id):
+    state = store._read_guild(store._connect(), guild_id)
+    current = state['current'].title if state['current'] is not None else None
+    return current, [t.title for t in state['queue']]
+
+
+def test_playing_the_next_song_writes_few_rows(store):
+    guild_player = fill(GUILD_ID, songs=100)
+    asyncio.run(store.flush())
+    changes = store._conn.total_changes
+    guild_player.current = guild_player.queue.popleft()
+    guild_player.queue.append(bot.Track('https://www.youtube.com/watch?v=songnew0000', title='New'))
+    bot.save_state(GUILD_ID)
+    asyncio.run(store.flush())
+    assert store._conn.total_changes - changes <= 3
+    assert saved_titles(store, GUILD_ID) == ('Song 0', [f'Song {i}' for i in range(1, 100)] + ['New'])
+
+
+def test_saved_queue_follows_every_change(store):
+    rng = random.Random(1)
+    guild_player = fill(GUILD_ID, songs=20)
+    operations = [
+        lambda q: q.popleft(),
+        lambda q: q.appendleft(bot.Track(f'https://x/{rng.random()}', title=f'Front {rng.random()}')),
+        lambda q: q.append(bot.Track(f'https://x/{rng.random()}', title=f'Back {rng.random()}')),
+        lambda q: rng.shuffle(q),
+        lambda q: q.remove(q[len(q) // 2]),
+        lambda q: q.rotate(1),
+    ]
+    for _ in range(200):
+        queue = guild_player.queue
+        if rng.random() < 0.3 and queue:
+            guild_player.current = queue.popleft()
+        elif rng.random() < 0.1:
+            guild_player.current = None
+        elif queue:
+            rng.choice(operations)(queue)
+        else:
+            operations[2](queue)
+        bot.save_state(GUILD_ID)
+        asyncio.run(store.flush())
+        current = guild_player.current.title if guild_player.current is not None else None
+        assert saved_titles(store, GUILD_ID) == (current, [t.title for t in guild_player.queue])
+
+
+def test_startup_loads_only_playing_guilds(store, monkeypatch):
+    monkeypatch.setattr(bot, 'owns_guild', lambda guild_id: True)
+    fill(GUILD_ID)
+    playing = fill(GUILD_ID + 1)
+    playing.channels = (1, 2)
+    asyncio.run(store.flush())
+    bot.players.clear()
+    asyncio.run(bot.restore_state())
+    assert list(bot.players) == [GUILD_ID + 1]
+    assert len(bot.get_player(GUILD_ID).queue) == 3